@@ -0,0 +1,839 @@
+# -*- coding: utf-8 -*-
+"""Plate detection, segmentation and recognition used by the License Plate
+Recognition (using pretrained MobileNetV2) notebook.
+
+The functions live in their own module so that the bulk worker processes can
+import them without running the notebook cells. Run it as a script to
+recognize a directory of images:
+
+    python alpr_pipeline.py <images dir or list file> plates.jsonl --processes 4
+"""
+# pylint: disable=invalid-name, redefined-outer-name, missing-docstring, non-parent-init-called, trailing-whitespace, line-too-long
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from os.path import splitext
+
+import cv2
+import numpy as np
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+import tensorflow as tf
+from keras.models import model_from_json
+from PIL import Image
+from sklearn.preprocessing import LabelEncoder
+
+
+class Label:
+    __slots__ = ('__tl', '__br', '__cl', '__prob')
+
+    def __init__(self, cl=-1, tl=np.array([0., 0.]), br=np.array([0., 0.]), prob=None):
+        self.__tl = tl
+        self.__br = br
+        self.__cl = cl
+        self.__prob = prob
+
+    def __str__(self):
+        return 'Class: %d, top left(x: %f, y: %f), bottom right(x: %f, y: %f)' % (
+        self.__cl, self.__tl[0], self.__tl[1], self.__br[0], self.__br[1])
+
+    def copy(self):
+        return Label(self.__cl, self.__tl, self.__br)
+
+    def wh(self): return self.__br - self.__tl
+
+    def cc(self): return self.__tl + self.wh() / 2
+
+    def tl(self): return self.__tl
+
+    def br(self): return self.__br
+
+    def tr(self): return np.array([self.__br[0], self.__tl[1]])
+
+    def bl(self): return np.array([self.__tl[0], self.__br[1]])
+
+    def cl(self): return self.__cl
+
+    def area(self): return np.prod(self.wh())
+
+    def prob(self): return self.__prob
+
+    def set_class(self, cl):
+        self.__cl = cl
+
+    def set_tl(self, tl):
+        self.__tl = tl
+
+    def set_br(self, br):
+        self.__br = br
+
+    def set_wh(self, wh):
+        cc = self.cc()
+        self.__tl = cc - .5 * wh
+        self.__br = cc + .5 * wh
+
+    def set_prob(self, prob):
+        self.__prob = prob
+
+class DLabel(Label):
+    __slots__ = ('pts',)
+
+    def __init__(self, cl, pts, prob, tl=None, br=None):
+        self.pts = pts
+        # tl/br are passed in when the label is a view into a LabelBatch
+        if tl is None:
+            tl = np.amin(pts, axis=1)
+        if br is None:
+            br = np.amax(pts, axis=1)
+        Label.__init__(self, cl, tl, br, prob)
+
+def getWH(shape):
+    return np.array(shape[1::-1]).astype(float)
+
+def IOU(tl1, br1, tl2, br2):
+    wh1, wh2 = br1-tl1, br2-tl2
+    assert((wh1 >= 0).all() and (wh2 >= 0).all())
+    
+    intersection_wh = np.maximum(np.minimum(br1, br2) - np.maximum(tl1, tl2), 0)
+    intersection_area = np.prod(intersection_wh)
+    area1, area2 = (np.prod(wh1), np.prod(wh2))
+    union_area = area1 + area2 - intersection_area
+    return intersection_area/union_area
+
+def IOU_labels(l1, l2):
+    return IOU(l1.tl(), l1.br(), l2.tl(), l2.br())
+
+def IOU_matrix(boxes):
+    # boxes is (N, 4) as [tlx, tly, brx, bry]; returns the (N, N) pairwise IoU
+    tl, br = boxes[:, :2], boxes[:, 2:]
+    area = np.prod(br - tl, axis=1)
+    intersection_wh = np.maximum(np.minimum(br[:, None], br[None]) - np.maximum(tl[:, None], tl[None]), 0)
+    intersection_area = np.prod(intersection_wh, axis=2)
+    union_area = area[:, None] + area[None] - intersection_area
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return intersection_area/union_area
+
+def nms_boxes(boxes, scores, iou_threshold=0.5):
+    # Greedy NMS over an (N, 4) box array and (N,) scores, returns the kept indices
+    # in descending score order (ties keep their input order, like list.sort)
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    overlap = IOU_matrix(boxes[order]) > iou_threshold
+
+    keep = []
+    suppressed = np.zeros(len(order), dtype=bool)
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(order[i])
+        suppressed |= overlap[i]
+    return np.array(keep, dtype=int)
+
+def labels_to_boxes(Labels):
+    return np.array([np.concatenate((l.tl(), l.br())) for l in Labels]).reshape(-1, 4)
+
+def nms(Labels, iou_threshold=0.5):
+    if not Labels:
+        return []
+    scores = np.array([l.prob() for l in Labels])
+    keep = nms_boxes(labels_to_boxes(Labels), scores, iou_threshold)
+    return [Labels[i] for i in keep]
+
+# Struct-of-arrays container for many candidates: cl and prob are (N,), tl and
+# br are (N, 2) and pts (optional) is (N, 2, 4). Integer indexing returns a
+# Label/DLabel whose fields are views into the arrays, anything else (slices,
+# masks, index arrays) returns a smaller LabelBatch.
+class LabelBatch:
+    __slots__ = ('cl', 'tl', 'br', 'prob', 'pts')
+
+    def __init__(self, cl, tl, br, prob, pts=None):
+        self.tl = np.asarray(tl, dtype=float).reshape(-1, 2)
+        self.br = np.asarray(br, dtype=float).reshape(-1, 2)
+        self.cl = np.broadcast_to(np.asarray(cl), (len(self.tl),))
+        self.prob = np.asarray(prob, dtype=float).reshape(-1)
+        self.pts = None if pts is None else np.asarray(pts, dtype=float).reshape(-1, 2, 4)
+
+    @classmethod
+    def from_quads(cls, pts, prob, cl=0):
+        pts = np.asarray(pts, dtype=float).reshape(-1, 2, 4)
+        return cls(cl, pts.min(axis=2), pts.max(axis=2), prob, pts)
+
+    @classmethod
+    def from_labels(cls, Labels):
+        pts = [l.pts for l in Labels] if Labels and all(isinstance(l, DLabel) for l in Labels) else None
+        return cls([l.cl() for l in Labels], [l.tl() for l in Labels], [l.br() for l in Labels],
+                   [l.prob() for l in Labels], pts)
+
+    def __len__(self):
+        return len(self.tl)
+
+    def __getitem__(self, idx):
+        if np.ndim(idx) == 0 and not isinstance(idx, slice):
+            if self.pts is None:
+                return Label(self.cl[idx], self.tl[idx], self.br[idx], self.prob[idx])
+            return DLabel(self.cl[idx], self.pts[idx], self.prob[idx], self.tl[idx], self.br[idx])
+        return LabelBatch(self.cl[idx], self.tl[idx], self.br[idx], self.prob[idx],
+                          None if self.pts is None else self.pts[idx])
+
+    def labels(self):
+        return [self[i] for i in range(len(self))]
+
+    def wh(self): return self.br - self.tl
+
+    def cc(self): return self.tl + self.wh() / 2
+
+    def area(self): return np.prod(self.wh(), axis=1)
+
+    def boxes(self): return np.concatenate((self.tl, self.br), axis=1)
+
+    def iou(self):
+        return IOU_matrix(self.boxes())
+
+    def sort(self, reverse=True):
+        order = np.argsort(-self.prob if reverse else self.prob, kind='stable')
+        return self[order]
+
+    def nms(self, iou_threshold=0.5):
+        return self[nms_boxes(self.boxes(), self.prob, iou_threshold)]
+
+
+
+def find_T_matrix(pts, t_pts):
+    A = np.zeros((8, 9))
+    for i in range(0, 4):
+        xi = pts[:, i]
+        xil = t_pts[:, i]
+        xi = xi.T
+        
+        A[i*2, 3:6] = -xil[2]*xi
+        A[i*2, 6:] = xil[1]*xi
+        A[i*2+1, :3] = xil[2]*xi
+        A[i*2+1, 6:] = -xil[0]*xi
+
+    [U, S, V] = np.linalg.svd(A)
+    H = V[-1, :].reshape((3, 3))
+    return H
+
+# Closed-form version of find_T_matrix for many quads at once: pts and t_pts are
+# (N, 2, 4) (or (2, 4), broadcast) source and target corners, and H is the (N, 3, 3)
+# homography with H[2, 2] = 1, the same as cv2.getPerspectiveTransform
+def find_T_matrices(pts, t_pts):
+    pts = np.asarray(pts, dtype=float)[..., :2, :]
+    t_pts = np.asarray(t_pts, dtype=float)[..., :2, :]
+    pts, t_pts = np.broadcast_arrays(pts.reshape(-1, 2, 4), t_pts.reshape(-1, 2, 4))
+    x, y = pts[:, 0], pts[:, 1]
+    u, v = t_pts[:, 0], t_pts[:, 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+
+    A = np.empty((len(pts), 8, 8))
+    A[:, 0::2] = np.stack((x, y, ones, zeros, zeros, zeros, -u*x, -u*y), axis=-1)
+    A[:, 1::2] = np.stack((zeros, zeros, zeros, x, y, ones, -v*x, -v*y), axis=-1)
+    b = np.empty((len(pts), 8))
+    b[:, 0::2] = u
+    b[:, 1::2] = v
+
+    try:
+        h = np.linalg.solve(A, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        # a degenerate quad (collinear corners) makes its system singular; use
+        # the least-squares solution for every quad instead of raising
+        h = np.stack([np.linalg.lstsq(a, bb, rcond=None)[0] for a, bb in zip(A, b)])
+    return np.concatenate((h, np.ones((len(pts), 1))), axis=1).reshape(-1, 3, 3)
+
+def getRectPts(tlx, tly, brx, bry):
+    return np.matrix([[tlx, brx, brx, tlx], [tly, tly, bry, bry], [1, 1, 1, 1]], dtype=float)
+
+def normal(pts, side, mn, MN):
+    pts_MN_center_mn = pts * side
+    pts_MN = pts_MN_center_mn + mn.reshape((2, 1))
+    pts_prop = pts_MN / MN.reshape((2, 1))
+    return pts_prop
+
+def affine_quads(affines, xx, yy, MN, side, vx=0.5, vy=0.5):
+    # Batched version of the per-cell A*base(vx, vy) + normal() step, for all
+    # selected cells at once. Returns the (N, 2, 4) warped and frontal quads.
+    A = np.array(affines, dtype=float).reshape(-1, 2, 3)
+    A[:, 0, 0] = np.maximum(A[:, 0, 0], 0)
+    A[:, 1, 1] = np.maximum(A[:, 1, 1], 0)
+    # identity transformation
+    B = np.zeros_like(A)
+    B[:, 0, 0] = A[:, 0, 0]
+    B[:, 1, 1] = A[:, 1, 1]
+
+    base = np.array([[-vx, vx, vx, -vx], [-vy, -vy, vy, vy], [1, 1, 1, 1]], dtype=float)
+    quads = np.einsum('knij,jc->knic', np.stack((A, B)), base)
+
+    mn = np.stack((yy + 0.5, xx + 0.5), axis=-1).astype(float)
+    quads = (quads * side + mn[None, :, :, None]) / np.reshape(MN, (1, 1, 2, 1))
+    return quads[0], quads[1]
+
+def quads_to_boxes(quads):
+    # (N, 2, 4) quads to (N, 4) [tlx, tly, brx, bry] boxes, as DLabel does per label
+    return np.concatenate((quads.min(axis=2), quads.max(axis=2)), axis=1)
+
+# Reconstruction function from predict value into plate crpoped from image
+# With top_k only the top_k most probable plates are warped into TLp, Cor still
+# holds the corners of every plate found (in the same order)
+def reconstruct(I, Iresized, Yr, lp_threshold, top_k=None):
+    # 4 max-pooling layers, stride = 2
+    net_stride = 2**4
+    side = ((208 + 40)/2)/net_stride
+
+    # one line and two lines license plate size
+    one_line = (470, 110)
+    two_lines = (280, 200)
+
+    Probs = Yr[..., 0]
+    Affines = Yr[..., 2:]
+
+    xx, yy = np.where(Probs > lp_threshold)
+    # CNN input image size 
+    WH = getWH(Iresized.shape)
+    # output feature map size
+    MN = WH/net_stride
+
+    vxx = vyy = 0.5 #alpha
+    pts, pts_frontal = affine_quads(Affines[xx, yy], xx, yy, MN, side, vxx, vyy)
+    probs = Probs[xx, yy]
+
+    # suppress on the raw corner arrays, Label objects are only views of the survivors
+    final_batch = LabelBatch.from_quads(pts, probs).nms(0.1)
+    final_batch_frontal = LabelBatch.from_quads(pts_frontal, probs).nms(0.1)
+    final_labels = final_batch.labels()
+
+    #print(final_labels_frontal)
+    assert len(final_batch_frontal), "No License plate is founded!"
+
+    # LP size and type
+    frontal_wh = final_batch_frontal.wh()[0]
+    out_size, lp_type = (two_lines, 2) if ((frontal_wh[0] / frontal_wh[1]) < 1.7) else (one_line, 1)
+
+    TLp = []
+    Cor = []
+    if len(final_labels):
+        # final_batch is already sorted by probability by nms
+        t_ptsh = np.asarray(getRectPts(0, 0, out_size[0], out_size[1]))
+        ptsh = np.concatenate((final_batch.pts * getWH(I.shape).reshape((1, 2, 1)),
+                               np.ones((len(final_batch), 1, 4))), axis=1)
+        Cor = list(ptsh)
+        for H in find_T_matrices(ptsh[:top_k], t_ptsh):
+            TLp.append(cv2.warpPerspective(I, H, out_size, borderValue=0))
+    return final_labels, TLp, lp_type, Cor
+
+def resize_for_lp(I, max_dim):
+    min_dim_img = min(I.shape[:2])
+    factor = float(max_dim) / min_dim_img
+    w, h = (np.array(I.shape[1::-1], dtype=float) * factor).astype(int).tolist()
+    return cv2.resize(I, (w, h))
+
+# uint8 images stay uint8 through resize and warp, only the network input is
+# converted to float32 in [0, 1], into a per-thread buffer that is reused as
+# long as the frame size does not change
+_input_buffers = threading.local()
+
+def network_input(Iresized):
+    if Iresized.dtype != np.uint8:
+        T = Iresized.copy()
+        return T.reshape((1, T.shape[0], T.shape[1], T.shape[2]))
+    # one buffer per thread, reallocated only when the input shape changes
+    T = getattr(_input_buffers, 'T', None)
+    if T is None or T.shape[1:] != Iresized.shape:
+        T = _input_buffers.T = np.empty((1,) + Iresized.shape, dtype=np.float32)
+    np.multiply(Iresized, np.float32(1/255.), out=T[0])
+    return T
+
+def plate_to_uint8(LpImg):
+    # plates warped from a uint8 image are already 0-255
+    return LpImg if LpImg.dtype == np.uint8 else cv2.convertScaleAbs(LpImg, alpha=(255.0))
+
+# detect_lp returns an LPResult, which unpacks like the old (L, TLp, lp_type, Cor)
+# tuple. Frames where no cell of the probability map is above lp_threshold exit
+# right after predict with NO_PLATE (found is False) instead of going through
+# reconstruct and its assert. detect_stats counts how many frames took that path.
+class LPResult(namedtuple('LPResult', ['L', 'TLp', 'lp_type', 'Cor'])):
+    __slots__ = ()
+
+    @property
+    def found(self):
+        return len(self.L) > 0
+
+NO_PLATE = LPResult((), (), 0, ())
+
+detect_stats = {'frames': 0, 'early_exit': 0}
+_detect_stats_lock = threading.Lock()
+
+def _count_frame(early_exit):
+    with _detect_stats_lock:
+        detect_stats['frames'] += 1
+        detect_stats['early_exit'] += early_exit
+
+def reconstruct_or_none(I, Iresized, Yr, lp_threshold, top_k=None):
+    if not Yr[..., 0].max() > lp_threshold:
+        _count_frame(True)
+        return NO_PLATE
+    _count_frame(False)
+    return LPResult(*reconstruct(I, Iresized, Yr, lp_threshold, top_k))
+
+def detect_lp(model, I, max_dim, lp_threshold, top_k=None):
+    Iresized = resize_for_lp(I, max_dim)
+    T = network_input(Iresized)
+    Yr = model.predict(T)
+    Yr = np.squeeze(Yr)
+    #print(Yr.shape)
+    return reconstruct_or_none(I, Iresized, Yr, lp_threshold, top_k)
+
+# Coarse-to-fine detection: tries the sizes in max_dims from small to large and
+# stops at the first one whose best plate has probability >= confidence. If no
+# size is confident enough the most probable result is returned, and if nothing
+# is found at all NO_PLATE.
+def detect_lp_adaptive(model, I, max_dims, lp_threshold, confidence=0.9, top_k=None):
+    best, best_prob = NO_PLATE, -1.
+    for max_dim in sorted(set(max_dims)):
+        result = detect_lp(model, I, max_dim, lp_threshold, top_k)
+        if not result.found:
+            continue
+        prob = result.L[0].prob()
+        if prob > best_prob:
+            best, best_prob = result, prob
+        if prob >= confidence:
+            break
+    return best
+
+# Batched version of detect_lp for many images. Images are grouped by their
+# resized (w, h) and each group goes through the network in one predict call.
+# With bucket=k the sizes are rounded up to a multiple of k and zero padded so
+# that more images share a forward pass; the output map is cropped back to the
+# unpadded size (this can shift border activations slightly, so the default
+# keeps exact sizes). Returns one LPResult per image, NO_PLATE where no plate
+# is found.
+def detect_lp_batch(model, images, max_dim, lp_threshold, batch_size=8, bucket=None, top_k=None):
+    net_stride = 2**4
+    max_dims = max_dim if np.iterable(max_dim) else [max_dim] * len(images)
+    resized = [resize_for_lp(I, d) for I, d in zip(images, max_dims)]
+
+    buckets = {}
+    for idx, Iresized in enumerate(resized):
+        h, w = Iresized.shape[:2]
+        if bucket:
+            h, w = -(-h // bucket) * bucket, -(-w // bucket) * bucket
+        buckets.setdefault((h, w), []).append(idx)
+
+    results = [NO_PLATE] * len(images)
+    for (h, w), idxs in buckets.items():
+        T = np.zeros((len(idxs), h, w, resized[idxs[0]].shape[2]), dtype=np.float32)
+        for j, idx in enumerate(idxs):
+            rh, rw = resized[idx].shape[:2]
+            T[j, :rh, :rw] = network_input(resized[idx])[0]
+        Yb = model.predict(T, batch_size=batch_size)
+
+        for j, idx in enumerate(idxs):
+            rh, rw = resized[idx].shape[:2]
+            Yr = Yb[j]
+            if bucket:
+                # wpod-net pools with 'valid' padding, so the unpadded input gives a
+                # floor(size / 16) map, which is what is kept of the padded one
+                Yr = Yr[:rh // net_stride, :rw // net_stride]
+            results[idx] = reconstruct_or_none(images[idx], resized[idx], Yr, lp_threshold, top_k)
+    return results
+
+# Models
+
+def load_model(path):
+  try:
+    path = splitext(path)[0]
+    with open('%s.json' % path, 'r') as json_file:
+      model_json = json_file.read()
+    model = model_from_json(model_json, custom_objects={})
+    model.load_weights('%s.h5' % path)
+    print('Loading model successfully...')
+    return model
+  except Exception as e:
+    print(e)
+
+wpod_net_path = "/content/Plate_detect_and_recognize/wpod-net.json"
+character_model_path = "/content/Plate_detect_and_recognize/MobileNets_character_recognition.json"
+character_weights_path = "/content/Plate_detect_and_recognize/License_character_recognition_weight.h5"
+character_classes_path = "/content/Plate_detect_and_recognize/license_character_classes.npy"
+
+def load_character_model(path=character_model_path, weights=character_weights_path):
+  with open(path, 'r') as json_file:
+    model = model_from_json(json_file.read())
+  model.load_weights(weights)
+  print("[INFO] Model loaded successfully...")
+  return model
+
+def load_character_labels(path=character_classes_path):
+  labels = LabelEncoder()
+  labels.classes_ = np.load(path)
+  print("[INFO] Labels loaded successfully...")
+  return labels
+
+class TracedModel:
+  # Keras model wrapper that runs predict through a traced tf.function
+  def __init__(self, model, input_shape):
+    self.model = model
+    self._predict = tf.function(lambda x: model(x, training=False),
+                                input_signature=[tf.TensorSpec(shape=(None,) + input_shape, dtype=tf.float32)])
+
+  def predict(self, x, batch_size=32, **kwargs):
+    x = np.asarray(x, dtype=np.float32)
+    outputs = [self._predict(tf.constant(x[i:i+batch_size])).numpy() for i in range(0, len(x), batch_size)]
+    return np.concatenate(outputs)
+
+  def __getattr__(self, name):
+    return getattr(self.model, name)
+
+class TFLiteModel:
+  # TFLite interpreter with the same predict() as a Keras model. The input shape
+  # is resized on the fly, so wpod-net keeps working on any image size.
+  def __init__(self, path, num_threads=None):
+    self.path = path
+    self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+    self.interpreter.allocate_tensors()
+    self._input = self.interpreter.get_input_details()[0]
+    self._output = self.interpreter.get_output_details()[0]
+    self._shape = tuple(self._input['shape'])
+    self._lock = threading.Lock()
+
+  def predict(self, x, batch_size=32, **kwargs):
+    x = np.asarray(x, dtype=np.float32)
+    outputs = []
+    with self._lock:
+      for i in range(0, len(x), batch_size):
+        batch = x[i:i+batch_size]
+        if batch.shape != self._shape:
+          self.interpreter.resize_tensor_input(self._input['index'], batch.shape)
+          self.interpreter.allocate_tensors()
+          self._shape = batch.shape
+        self.interpreter.set_tensor(self._input['index'], batch)
+        self.interpreter.invoke()
+        outputs.append(self.interpreter.get_tensor(self._output['index']).copy())
+    return np.concatenate(outputs)
+
+# name -> (loader, traced input shape without the batch axis, warm-up input shape)
+MODEL_SPECS = {
+  'wpod-net': (lambda: load_model(wpod_net_path), (None, None, 3), (1, 256, 384, 3)),
+  'character': (load_character_model, (80, 80, 3), (1, 80, 80, 3)),
+}
+
+# int8 models written by export_tflite_int8 in the notebook, used with backend='tflite'
+TFLITE_PATHS = {
+  'wpod-net': '/content/wpod-net_int8.tflite',
+  'character': '/content/character_int8.tflite',
+}
+
+_model_registry = {}
+_model_registry_lock = threading.Lock()
+
+def get_model(name, traced=False, warmup=True, backend='keras'):
+  key = (name, 'tflite') if backend == 'tflite' else (name, traced)
+  with _model_registry_lock:
+    if key not in _model_registry:
+      loader, input_shape, warmup_shape = MODEL_SPECS[name]
+      if backend == 'tflite':
+        model = TFLiteModel(TFLITE_PATHS[name])
+      else:
+        base = _model_registry.get((name, False))
+        if base is None:
+          base = loader()
+          if base is None:
+            return None
+          if warmup:
+            base.predict(np.zeros(warmup_shape, dtype=np.float32))
+          # the plain model is always registered, so it is never loaded twice
+          _model_registry[(name, False)] = base
+        model = TracedModel(base, input_shape) if traced else base
+      if warmup and model is not _model_registry.get((name, False)):
+        model.predict(np.zeros(warmup_shape, dtype=np.float32))
+      _model_registry[key] = model
+    return _model_registry[key]
+
+def get_labels(path=character_classes_path):
+  with _model_registry_lock:
+    if ('labels', path) not in _model_registry:
+      _model_registry[('labels', path)] = load_character_labels(path)
+    return _model_registry[('labels', path)]
+
+# Decoding
+
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+# EXIF orientations 5 to 8 turn the image by 90 degrees, which swaps width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+def load_vehicle(image_path, Dmax=608, reduce_above=2):
+  with Image.open(image_path) as im:
+    # only reads the header
+    width, height = im.size
+    orientation = im.getexif().get(0x0112, 1)
+  # cv2.imread applies the EXIF rotation, so the image comes out upright and the
+  # scale maps back to the upright original
+  if orientation in TRANSPOSED_ORIENTATIONS:
+    width, height = height, width
+  flag = cv2.IMREAD_COLOR
+  for factor, reduced_flag in REDUCED_FLAGS:
+    if min(width, height) / factor >= reduce_above * Dmax:
+      flag = reduced_flag
+      break
+  img = cv2.imread(image_path, flag)
+  img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+  scale = np.array([width / img.shape[1], height / img.shape[0]])
+  return img, scale
+
+def rescale_cor(cor, scale):
+  return [np.concatenate((c[:2] * scale.reshape((2, 1)), c[2:])) for c in cor]
+
+# Character segmentation
+
+# Create sort_contours() function to grab the contour of each digit from left to right
+def sort_contours(cnts,reverse = False):
+    i = 0
+    boundingBoxes = [cv2.boundingRect(c) for c in cnts]
+    (cnts, boundingBoxes) = zip(*sorted(zip(cnts, boundingBoxes),
+                                        key=lambda b: b[1][i], reverse=reverse))
+    return cnts
+
+def character_boxes_contours(binary, plate_height):
+    cont, _  = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    if not len(cont):
+        return boxes
+    for c in sort_contours(cont):
+        (x, y, w, h) = cv2.boundingRect(c)
+        ratio = h/w
+        if 1<=ratio<=3.5 and h/plate_height>=0.5:
+            boxes.append((x, y, w, h))
+    return boxes
+
+def binarize_plate(LpImg):
+    plate_image = plate_to_uint8(LpImg)
+    gray = cv2.cvtColor(plate_image, cv2.COLOR_BGR2GRAY)
+    blur = cv2.GaussianBlur(gray,(7,7),0)
+    binary = cv2.threshold(blur, 180, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+    kernel3 = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    thre_mor = cv2.morphologyEx(binary, cv2.MORPH_DILATE, kernel3)
+    return binary, thre_mor
+
+def segment_characters(LpImg, digit_w=30, digit_h=60):
+    binary, thre_mor = binarize_plate(LpImg)
+    boxes = character_boxes_contours(binary, binary.shape[0])
+
+    crop_characters = []
+    for (x, y, w, h) in boxes:
+        curr_num = thre_mor[y:y+h,x:x+w]
+        curr_num = cv2.resize(curr_num, dsize=(digit_w, digit_h))
+        _, curr_num = cv2.threshold(curr_num, 220, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        crop_characters.append(curr_num)
+    return crop_characters
+
+# Character recognition
+
+# all characters of a plate in one predict call, instead of one call per character
+def characters_to_tensor(crop_characters):
+    X = np.empty((len(crop_characters),80,80,3), dtype=np.float32)
+    for i,character in enumerate(crop_characters):
+        X[i] = cv2.resize(character,(80,80))[...,np.newaxis]
+    return X
+
+def recognize_characters(crop_characters,model,labels,batch_size=64):
+    if not len(crop_characters):
+        return np.array([], dtype=labels.classes_.dtype)
+    predictions = model.predict(characters_to_tensor(crop_characters), batch_size=batch_size)
+    return labels.classes_[np.argmax(predictions, axis=1)]
+
+# for bulk jobs: characters of many plates go through the model together and
+# the result is split back into one string per plate
+def recognize_plates(plates_characters,model,labels,batch_size=64):
+    if not len(plates_characters):
+        return []
+    all_characters = [character for crop_characters in plates_characters for character in crop_characters]
+    predictions = recognize_characters(all_characters,model,labels,batch_size)
+    splits = np.cumsum([len(crop_characters) for crop_characters in plates_characters])[:-1]
+    return [''.join(chars) for chars in np.split(predictions, splits)]
+
+# Streaming: one stage of a thread pipeline connected by queues, None is the
+# end-of-stream sentinel. With drop=True a full out_queue loses its oldest item.
+
+class PipelineStage:
+    def __init__(self, name, func, in_queue, out_queue, workers=1, drop=True):
+        self.name = name
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.drop = drop
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_error = None
+        self.busy_time = 0.0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+        self._running = workers
+        self._threads = [threading.Thread(target=self._work, name='%s-%d' % (name, i), daemon=True)
+                         for i in range(workers)]
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        for t in self._threads:
+            t.start()
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+    def put(self, item):
+        if not self.drop:
+            self.out_queue.put(item)
+            return
+        while True:
+            try:
+                self.out_queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.out_queue.get_nowait()
+                    with self._lock:
+                        self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _work(self):
+        try:
+            while True:
+                item = self.in_queue.get()
+                if item is None:
+                    # let the sibling workers see the sentinel
+                    self.in_queue.put(None)
+                    return
+                with self._lock:
+                    self.max_queue_depth = max(self.max_queue_depth, self.in_queue.qsize() + 1)
+                start = time.perf_counter()
+                try:
+                    result = self.func(item)
+                except Exception as e:
+                    # a corrupt frame or a plate that fails to warp is dropped
+                    # and counted, the worker goes on with the next item
+                    with self._lock:
+                        self.busy_time += time.perf_counter() - start
+                        self.failed += 1
+                        self.last_error = repr(e)
+                    continue
+                with self._lock:
+                    self.busy_time += time.perf_counter() - start
+                    self.processed += 1
+                if result is not None:
+                    self.put(result)
+        finally:
+            # the last worker to stop forwards the sentinel, however it stopped
+            with self._lock:
+                self._running -= 1
+                last = self._running == 0
+            if last:
+                self.out_queue.put(None)
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.start_time
+        return {'processed': self.processed,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'last_error': self.last_error,
+                'fps': self.processed / elapsed if elapsed else 0.0,
+                'busy_time': self.busy_time,
+                'queue_depth': self.in_queue.qsize(),
+                'max_queue_depth': self.max_queue_depth}
+
+# Bulk recognition
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def list_images(source):
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, '**', '*'), recursive=True)
+        return sorted(p for p in paths if p.lower().endswith(IMAGE_EXTENSIONS))
+    with open(source) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def alpr_image(image_path, wpod_net, model, labels, Dmax=608, Dmin=256, lp_threshold=0.5):
+    timings = {}
+    start = time.perf_counter()
+    vehicle, scale = load_vehicle(image_path, Dmax)
+    timings['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ratio = float(max(vehicle.shape[:2])) / min(vehicle.shape[:2])
+    bound_dim = min(int(ratio * Dmin), Dmax)
+    _, LpImg, lp_type, cor = detect_lp(wpod_net, vehicle, bound_dim, lp_threshold)
+    timings['detect'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    characters = [segment_characters(plate) for plate in LpImg]
+    timings['segment'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    texts = recognize_plates(characters, model, labels)
+    timings['recognize'] = time.perf_counter() - start
+
+    cor = rescale_cor(cor, scale)
+    return {'path': image_path,
+            'lp_type': int(lp_type),
+            'plates': [{'text': str(text), 'cor': c[:2].tolist()} for text, c in zip(texts, cor)],
+            'timings': timings}
+
+_bulk_worker = {}
+
+def _init_bulk_worker(traced, options, backend='keras'):
+    # parallelism comes from the processes, one TF thread each avoids oversubscription
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    _bulk_worker['models'] = (get_model('wpod-net', traced=traced, backend=backend),
+                              get_model('character', traced=traced, backend=backend), get_labels())
+    _bulk_worker['options'] = options
+
+def _bulk_worker_run(image_path):
+    try:
+        return alpr_image(image_path, *_bulk_worker['models'], **_bulk_worker['options'])
+    except Exception as e:
+        return {'path': image_path, 'error': repr(e)}
+
+def bulk_alpr(source, output_path, processes=None, chunksize=4, traced=False, Dmax=608, Dmin=256, lp_threshold=0.5,
+              backend='keras'):
+    image_paths = list_images(source) if isinstance(source, str) else list(source)
+    options = {'Dmax': Dmax, 'Dmin': Dmin, 'lp_threshold': lp_threshold}
+    processed = failed = 0
+    start = time.perf_counter()
+    # TensorFlow is not fork-safe, so workers start from a fresh interpreter
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes, initializer=_init_bulk_worker, initargs=(traced, options, backend)) as pool, \
+         open(output_path, 'w') as out:
+        for result in pool.imap_unordered(_bulk_worker_run, image_paths, chunksize=chunksize):
+            out.write(json.dumps(result) + '\n')
+            processed += 1
+            failed += 'error' in result
+    elapsed = time.perf_counter() - start
+    print("[INFO] Processed {:d} images ({:d} failed) in {:.1f}s, {:.2f} images/s".format(
+        processed, failed, elapsed, processed / elapsed if elapsed else 0.0))
+    return processed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recognize license plates in bulk and write one JSON line per image.')
+    parser.add_argument('source', help='directory of images or text file with one image path per line')
+    parser.add_argument('output', help='JSONL file to write')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--chunksize', type=int, default=4)
+    parser.add_argument('--traced', action='store_true', help='run inference through tf.function')
+    parser.add_argument('--Dmax', type=int, default=608)
+    parser.add_argument('--Dmin', type=int, default=256)
+    parser.add_argument('--lp-threshold', type=float, default=0.5)
+    parser.add_argument('--backend', choices=('keras', 'tflite'), default='keras',
+                        help='tflite runs the int8 models from export_tflite_int8')
+    args = parser.parse_args(argv)
+    return bulk_alpr(args.source, args.output, args.processes, args.chunksize, args.traced,
+                     args.Dmax, args.Dmin, args.lp_threshold, args.backend)
+
+if __name__ == '__main__':
+    main()
@@ -13,224 +13,34 @@ The link to this article is:https://medium.com/@quangnhatnguyenle/detect-and-rec
 # Cloning the author's github
 !git clone https://github.com/quangnhat185/Plate_detect_and_recognize.git
 
-# Local functions used throughout the code for detecting license plates
-# pylint: disable=invalid-name, redefined-outer-name, missing-docstring, non-parent-init-called, trailing-whitespace, line-too-long
-import cv2
-import numpy as np
-
-
-class Label:
-    def __init__(self, cl=-1, tl=np.array([0., 0.]), br=np.array([0., 0.]), prob=None):
-        self.__tl = tl
-        self.__br = br
-        self.__cl = cl
-        self.__prob = prob
-
-    def __str__(self):
-        return 'Class: %d, top left(x: %f, y: %f), bottom right(x: %f, y: %f)' % (
-        self.__cl, self.__tl[0], self.__tl[1], self.__br[0], self.__br[1])
-
-    def copy(self):
-        return Label(self.__cl, self.__tl, self.__br)
-
-    def wh(self): return self.__br - self.__tl
-
-    def cc(self): return self.__tl + self.wh() / 2
-
-    def tl(self): return self.__tl
-
-    def br(self): return self.__br
-
-    def tr(self): return np.array([self.__br[0], self.__tl[1]])
-
-    def bl(self): return np.array([self.__tl[0], self.__br[1]])
-
-    def cl(self): return self.__cl
-
-    def area(self): return np.prod(self.wh())
-
-    def prob(self): return self.__prob
-
-    def set_class(self, cl):
-        self.__cl = cl
-
-    def set_tl(self, tl):
-        self.__tl = tl
-
-    def set_br(self, br):
-        self.__br = br
-
-    def set_wh(self, wh):
-        cc = self.cc()
-        self.__tl = cc - .5 * wh
-        self.__br = cc + .5 * wh
-
-    def set_prob(self, prob):
-        self.__prob = prob
-
-class DLabel(Label):
-    def __init__(self, cl, pts, prob):
-        self.pts = pts
-        tl = np.amin(pts, axis=1)
-        br = np.amax(pts, axis=1)
-        Label.__init__(self, cl, tl, br, prob)
-
-def getWH(shape):
-    return np.array(shape[1::-1]).astype(float)
-
-def IOU(tl1, br1, tl2, br2):
-    wh1, wh2 = br1-tl1, br2-tl2
-    assert((wh1 >= 0).all() and (wh2 >= 0).all())
-    
-    intersection_wh = np.maximum(np.minimum(br1, br2) - np.maximum(tl1, tl2), 0)
-    intersection_area = np.prod(intersection_wh)
-    area1, area2 = (np.prod(wh1), np.prod(wh2))
-    union_area = area1 + area2 - intersection_area
-    return intersection_area/union_area
-
-def IOU_labels(l1, l2):
-    return IOU(l1.tl(), l1.br(), l2.tl(), l2.br())
-
-def nms(Labels, iou_threshold=0.5):
-    SelectedLabels = []
-    Labels.sort(key=lambda l: l.prob(), reverse=True)
-    
-    for label in Labels:
-        non_overlap = True
-        for sel_label in SelectedLabels:
-            if IOU_labels(label, sel_label) > iou_threshold:
-                non_overlap = False
-                break
-
-        if non_overlap:
-            SelectedLabels.append(label)
-    return SelectedLabels
-
-
-
-def find_T_matrix(pts, t_pts):
-    A = np.zeros((8, 9))
-    for i in range(0, 4):
-        xi = pts[:, i]
-        xil = t_pts[:, i]
-        xi = xi.T
-        
-        A[i*2, 3:6] = -xil[2]*xi
-        A[i*2, 6:] = xil[1]*xi
-        A[i*2+1, :3] = xil[2]*xi
-        A[i*2+1, 6:] = -xil[0]*xi
-
-    [U, S, V] = np.linalg.svd(A)
-    H = V[-1, :].reshape((3, 3))
-    return H
-
-def getRectPts(tlx, tly, brx, bry):
-    return np.matrix([[tlx, brx, brx, tlx], [tly, tly, bry, bry], [1, 1, 1, 1]], dtype=float)
-
-def normal(pts, side, mn, MN):
-    pts_MN_center_mn = pts * side
-    pts_MN = pts_MN_center_mn + mn.reshape((2, 1))
-    pts_prop = pts_MN / MN.reshape((2, 1))
-    return pts_prop
-
-# Reconstruction function from predict value into plate crpoped from image
-def reconstruct(I, Iresized, Yr, lp_threshold):
-    # 4 max-pooling layers, stride = 2
-    net_stride = 2**4
-    side = ((208 + 40)/2)/net_stride
-
-    # one line and two lines license plate size
-    one_line = (470, 110)
-    two_lines = (280, 200)
-
-    Probs = Yr[..., 0]
-    Affines = Yr[..., 2:]
-
-    xx, yy = np.where(Probs > lp_threshold)
-    # CNN input image size 
-    WH = getWH(Iresized.shape)
-    # output feature map size
-    MN = WH/net_stride
-
-    vxx = vyy = 0.5 #alpha
-    base = lambda vx, vy: np.matrix([[-vx, -vy, 1], [vx, -vy, 1], [vx, vy, 1], [-vx, vy, 1]]).T
-    labels = []
-    labels_frontal = []
-
-    for i in range(len(xx)):
-        x, y = xx[i], yy[i]
-        affine = Affines[x, y]
-        prob = Probs[x, y]
-
-        mn = np.array([float(y) + 0.5, float(x) + 0.5])
-
-        # affine transformation matrix
-        A = np.reshape(affine, (2, 3))
-        A[0, 0] = max(A[0, 0], 0)
-        A[1, 1] = max(A[1, 1], 0)
-        # identity transformation
-        B = np.zeros((2, 3))
-        B[0, 0] = max(A[0, 0], 0)
-        B[1, 1] = max(A[1, 1], 0)
-
-        pts = np.array(A*base(vxx, vyy))
-        pts_frontal = np.array(B*base(vxx, vyy))
-
-        pts_prop = normal(pts, side, mn, MN)
-        frontal = normal(pts_frontal, side, mn, MN)
-
-        labels.append(DLabel(0, pts_prop, prob))
-        labels_frontal.append(DLabel(0, frontal, prob))
-        
-    final_labels = nms(labels, 0.1)
-    final_labels_frontal = nms(labels_frontal, 0.1)
-
-    #print(final_labels_frontal)
-    assert final_labels_frontal, "No License plate is founded!"
-
-    # LP size and type
-    out_size, lp_type = (two_lines, 2) if ((final_labels_frontal[0].wh()[0] / final_labels_frontal[0].wh()[1]) < 1.7) else (one_line, 1)
-
-    TLp = []
-    Cor = []
-    if len(final_labels):
-        final_labels.sort(key=lambda x: x.prob(), reverse=True)
-        for _, label in enumerate(final_labels):
-            t_ptsh = getRectPts(0, 0, out_size[0], out_size[1])
-            ptsh = np.concatenate((label.pts * getWH(I.shape).reshape((2, 1)), np.ones((1, 4))))
-            H = find_T_matrix(ptsh, t_ptsh)
-            Ilp = cv2.warpPerspective(I, H, out_size, borderValue=0)
-            TLp.append(Ilp)
-            Cor.append(ptsh)
-    return final_labels, TLp, lp_type, Cor
-
-def detect_lp(model, I, max_dim, lp_threshold):
-    min_dim_img = min(I.shape[:2])
-    factor = float(max_dim) / min_dim_img
-    w, h = (np.array(I.shape[1::-1], dtype=float) * factor).astype(int).tolist()
-    Iresized = cv2.resize(I, (w, h))
-    T = Iresized.copy()
-    T = T.reshape((1, T.shape[0], T.shape[1], T.shape[2]))
-    Yr = model.predict(T)
-    Yr = np.squeeze(Yr)
-    #print(Yr.shape)
-    L, TLp, lp_type, Cor = reconstruct(I, Iresized, Yr, lp_threshold)
-    return L, TLp, lp_type, Cor
-
 # Commented out IPython magic to ensure Python compatibility.
 # Importing necessary libraries
+import glob
+import hashlib
+import json
+import os
+import platform
+import queue
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import splitext, basename
+
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
-from os.path import splitext, basename
-from keras.models import model_from_json
-import glob
 # %matplotlib inline
 import matplotlib.gridspec as gridspec
+from PIL import Image
 from sklearn.preprocessing import LabelEncoder
-# ignore warning 
-import os
+from sklearn.model_selection import train_test_split
+# ignore warning
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import tensorflow as tf
 
 from keras.preprocessing.image import ImageDataGenerator
 from keras.applications import MobileNetV2
@@ -245,30 +55,23 @@ from keras.preprocessing.image import img_to_array
 from keras.preprocessing.image import load_img
 from keras.utils import to_categorical
 from keras.callbacks import ModelCheckpoint, EarlyStopping
-from keras.models import model_from_json
-from sklearn.preprocessing import LabelEncoder
-from sklearn.model_selection import train_test_split
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-import glob
-import numpy as np
+
+# Local functions used throughout the code for detecting license plates. They are
+# kept in alpr_pipeline.py next to this notebook, so that the bulk worker
+# processes further down can import them without running the notebook cells
+# (on Colab, upload alpr_pipeline.py to /content first).
+from alpr_pipeline import (getWH, IOU_matrix, LabelBatch, find_T_matrices, getRectPts, affine_quads,
+                           reconstruct, resize_for_lp, network_input, plate_to_uint8, detect_lp,
+                           detect_lp_adaptive, detect_lp_batch, TFLITE_PATHS, get_model, get_labels,
+                           load_vehicle, rescale_cor, sort_contours, character_boxes_contours,
+                           binarize_plate, segment_characters, recognize_characters, recognize_plates,
+                           PipelineStage, alpr_image, bulk_alpr, main)
 
 """Loading our model from the pre-trained one. This model was created by sergiomsilva and the source code is: https://github.com/sergiomsilva/alpr-unconstrained"""
 
-def load_model(path):
-  try:
-    path = splitext(path)[0]
-    with open('%s.json' % path, 'r') as json_file:
-      model_json = json_file.read()
-    model = model_from_json(model_json, custom_objects={})
-    model.load_weights('%s.h5' % path)
-    print('Loading model successfully...')
-    return model
-  except Exception as e:
-    print(e)
+"""Both networks are used again and again by the functions below (and by long-lived workers). get_model keeps a process-wide registry so that each model is loaded only once, on first use. With traced=True, inference goes through a tf.function with a fixed input signature. With warmup=True, one dummy batch is run right after loading, so the slow first call (graph tracing) happens at load time and not on the first real request."""
 
-wpod_net_path = "/content/Plate_detect_and_recognize/wpod-net.json"
-wpod_net = load_model(wpod_net_path)
+wpod_net = get_model('wpod-net')
 
 """Creating a function named preprocess_image to read and pre-process our plate images."""
 
@@ -280,6 +83,8 @@ def preprocess_image(image_path, resize=False):
     img = cv2.resize(img, (224, 224))
   return img
 
+"""preprocess_image turns every image into float64, which takes 8 times the memory of the decoded image, and resizing and warping then run on that. load_vehicle keeps the image in uint8 instead (detect_lp converts only the network input to float32). When the short side of the image is more than reduce_above times Dmax, it lets the JPEG decoder downscale by 2, 4 or 8 with cv2.IMREAD_REDUCED_*. It returns the image, turned upright according to its EXIF orientation like preprocess_image does, and the (x, y) scale that maps coordinates back to the upright original image."""
+
 """Now we visualize our vehicle dataset containing of 20 vehicle images with plate acquired from 10 different countries. The link to the dataset is: https://github.com/quangnhat185/Plate_detect_and_recognize/tree/master/Plate_examples"""
 
 image_paths = glob.glob('/content/Plate_detect_and_recognize/Plate_examples/*.jpg')
@@ -300,16 +105,51 @@ for i in range(cols*rows):
 plt.tight_layout(True)
 plt.show()
 
-"""The get_plate function processes the raw image, send it to our model and return the plate image (LpImg) and its coordinates (cor). If there is no plate founded, the program warn with an error "No license is founded"."""
+"""The get_plate function processes the raw image, send it to our model and return the plate image (LpImg) and its coordinates (cor). If there is no plate founded, LpImg and cor come back empty."""
 
-def get_plate(image_path, Dmax=608, Dmin=256):
-  vehicle = preprocess_image(image_path)
+def get_plate(image_path, Dmax=608, Dmin=256, uint8=False, adaptive=False, coarse_dims=None, confidence=0.9):
+  if uint8:
+    vehicle, scale = load_vehicle(image_path, Dmax)
+  else:
+    vehicle = preprocess_image(image_path)
   ratio = float(max(vehicle.shape[:2])) / min(vehicle.shape[:2])
   side = int(ratio * Dmin)
   bound_dim = min(side, Dmax)
-  _ , LpImg, _, cor = detect_lp(wpod_net, vehicle, bound_dim, lp_threshold=0.5)
+  if adaptive:
+    dims = [d for d in (coarse_dims or (Dmin,)) if d < bound_dim] + [bound_dim]
+    _ , LpImg, _, cor = detect_lp_adaptive(wpod_net, vehicle, dims, lp_threshold=0.5, confidence=confidence)
+  else:
+    _ , LpImg, _, cor = detect_lp(wpod_net, vehicle, bound_dim, lp_threshold=0.5)
+  if uint8:
+    cor = rescale_cor(cor, scale)
   return LpImg, cor
 
+"""With adaptive=True, get_plate first runs WPOD-net at a low resolution (coarse_dims, by default Dmin on the short side). It moves on to the full bound_dim only when no plate is found or the best plate's probability is below confidence. Large, near plates are then handled at a fraction of the cost. If no plate is found at any size, it returns empty lists instead of raising."""
+
+"""get_plates does the same for a list of images, running WPOD-net over all of them in batches instead of one predict call per image. Images without a plate give empty lists, like get_plate. show_plate draws the first plate of an image, or an empty "no plate" panel."""
+
+def get_plates(image_paths, Dmax=608, Dmin=256, batch_size=8, bucket=None, uint8=False):
+  if uint8:
+    vehicles, scales = zip(*[load_vehicle(path, Dmax) for path in image_paths]) if len(image_paths) else ([], [])
+  else:
+    vehicles = [preprocess_image(path) for path in image_paths]
+  bound_dims = []
+  for vehicle in vehicles:
+    ratio = float(max(vehicle.shape[:2])) / min(vehicle.shape[:2])
+    side = int(ratio * Dmin)
+    bound_dims.append(min(side, Dmax))
+  results = detect_lp_batch(wpod_net, vehicles, bound_dims, lp_threshold=0.5, batch_size=batch_size, bucket=bucket)
+  if uint8:
+    return [(list(r.TLp), rescale_cor(r.Cor, scale)) for r, scale in zip(results, scales)]
+  return [(list(r.TLp), list(r.Cor)) for r in results]
+
+def show_plate(LpImg):
+  plt.axis(False)
+  if len(LpImg):
+    plt.imshow(LpImg[0])
+  else:
+    plt.text(0.5, 0.5, 'no plate', ha='center', va='center')
+
 test_image = image_paths[12]
 LpImg, cor = get_plate(test_image)
 print('Detect %i plate(s) in'%len(LpImg), splitext(basename(test_image))[0])
@@ -320,12 +160,13 @@ plt.subplot(1,2,1)
 plt.axis(False)
 plt.imshow(preprocess_image(test_image))
 plt.subplot(1,2,2)
-plt.axis(False)
-plt.imshow(LpImg[0])
+show_plate(LpImg)
 
 """Now, we draw a bounding box with obtained coordinates of detected plate."""
 
 def draw_box(image_path, cor, thickness=3):
+  if not len(cor):
+    return preprocess_image(image_path)
   pts = []
   x_coordinates = cor[0][0]
   y_coordinates = cor[0][1]
@@ -349,14 +190,14 @@ fig = plt.figure(figsize=(12,6))
 cols = 5
 rows = 4
 fig_list = []
+plates = get_plates(image_paths[:cols*rows])
 
 for i in range(cols*rows):
   fig_list.append(fig.add_subplot(rows, cols, i+1))
   title = splitext(basename(image_paths[i]))[0]
   fig_list[-1].set_title(title)
-  LpImg,_ = get_plate(image_paths[i])
-  plt.axis(False)
-  plt.imshow(LpImg[0])
+  LpImg,_ = plates[i]
+  show_plate(LpImg)
 
 plt.tight_layout(True)
 plt.show()
@@ -377,17 +218,29 @@ def preprocess_image(image_path,resize=False):
         img = cv2.resize(img, (224,224))
     return img
 
-def get_plate(image_path, Dmax=608, Dmin=256):
-    vehicle = preprocess_image(image_path)
+def get_plate(image_path, Dmax=608, Dmin=256, uint8=False, adaptive=False, coarse_dims=None, confidence=0.9):
+    if uint8:
+        vehicle, scale = load_vehicle(image_path, Dmax)
+    else:
+        vehicle = preprocess_image(image_path)
     ratio = float(max(vehicle.shape[:2])) / min(vehicle.shape[:2])
     side = int(ratio * Dmin)
     bound_dim = min(side, Dmax)
-    _ , LpImg, _, cor = detect_lp(wpod_net, vehicle, bound_dim, lp_threshold=0.5)
+    if adaptive:
+        dims = [d for d in (coarse_dims or (Dmin,)) if d < bound_dim] + [bound_dim]
+        _ , LpImg, _, cor = detect_lp_adaptive(wpod_net, vehicle, dims, lp_threshold=0.5, confidence=confidence)
+    else:
+        _ , LpImg, _, cor = detect_lp(wpod_net, vehicle, bound_dim, lp_threshold=0.5)
+    if uint8:
+        cor = rescale_cor(cor, scale)
     return vehicle, LpImg, cor
 
 #test_image_path = "test_2.jpg"
 test_image_path = "/content/Plate_detect_and_recognize/Plate_examples/germany_car_plate.jpg"
 vehicle, LpImg,cor = get_plate(test_image_path)
+# the steps below walk through the first plate of this image
+if not len(LpImg):
+    raise ValueError("No plate found in %s, pick another test image" % test_image_path)
 
 fig = plt.figure(figsize=(12,6))
 grid = gridspec.GridSpec(ncols=2,nrows=1,figure=fig)
@@ -401,7 +254,7 @@ plt.imshow(LpImg[0])
 
 if (len(LpImg)): #check if there is at least one license image
     # Scales, calculates absolute values, and converts the result to 8-bit.
-    plate_image = cv2.convertScaleAbs(LpImg[0], alpha=(255.0))
+    plate_image = plate_to_uint8(LpImg[0])
     
     # convert to grayscale and blur the image
     gray = cv2.cvtColor(plate_image, cv2.COLOR_BGR2GRAY)
@@ -435,14 +288,6 @@ for i in range(len(plot_image)):
 
 """Now, we determine the contour of license characters using the findContours function of OpenCV. """
 
-# Create sort_contours() function to grab the contour of each digit from left to right
-def sort_contours(cnts,reverse = False):
-    i = 0
-    boundingBoxes = [cv2.boundingRect(c) for c in cnts]
-    (cnts, boundingBoxes) = zip(*sorted(zip(cnts, boundingBoxes),
-                                        key=lambda b: b[1][i], reverse=reverse))
-    return cnts
-
 cont, _  = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
 # creat a copy version "test_roi" of plat_image to draw bounding box
@@ -474,6 +319,8 @@ plt.axis(False)
 plt.imshow(test_roi)
 #plt.savefig('grab_digit_contour.png',dpi=300)
 
+"""The steps above packed into one function, from a plate image returned by get_plate to the list of binarized character crops."""
+
 """Visualizing the segmented characters"""
 
 fig = plt.figure(figsize=(14,4))
@@ -510,20 +357,52 @@ for i in range(cols*rows):
 
 plt.savefig("Visualize_dataset.jpg",dpi=300)
 
-# Arange input data and corresponding labels
-X=[]
-labels=[]
-
-for image_path in dataset_paths:
-  label = image_path.split(os.path.sep)[-2]
-  image=load_img(image_path,target_size=(80,80))
-  image=img_to_array(image)
-
-  X.append(image)
-  labels.append(label)
+"""Decoding tens of thousands of JPEGs one by one takes a while on every run. build_character_cache decodes the dataset once on a thread pool (PIL releases the GIL while it decodes and resizes). It writes the images into a single uint8 character_images.npy of shape (N, 80, 80, 3), next to character_labels.npy. The images are resized exactly like load_img(target_size=(80,80)) does, so the values are the same as before. Later runs open the arrays with np.load(mmap_mode='r') and start without any decoding. A hash of the path list is stored with the arrays, and the cache is rebuilt when dataset_paths changes."""
+
+def _decode_character(image_path):
+  # same as load_img(image_path, target_size=(80,80)), which resizes with nearest
+  with Image.open(image_path) as img:
+    img = img.convert('RGB')
+    if img.size != (80, 80):
+      img = img.resize((80, 80), Image.NEAREST)
+    return np.asarray(img, dtype=np.uint8)
+
+def _paths_digest(dataset_paths):
+  return hashlib.sha1('\n'.join(dataset_paths).encode('utf-8')).hexdigest()
+
+def build_character_cache(dataset_paths, cache_dir, workers=8):
+  os.makedirs(cache_dir, exist_ok=True)
+  images_path = os.path.join(cache_dir, 'character_images.npy')
+  X = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                shape=(len(dataset_paths), 80, 80, 3))
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    for i, image in enumerate(pool.map(_decode_character, dataset_paths)):
+      X[i] = image
+  X.flush()
+  del X
+  os.replace(images_path + '.tmp', images_path)
+  labels = np.array([image_path.split(os.path.sep)[-2] for image_path in dataset_paths])
+  np.save(os.path.join(cache_dir, 'character_labels.npy'), labels)
+  # written last, so an interrupted build is never mistaken for a complete one
+  with open(os.path.join(cache_dir, 'character_paths.sha1'), 'w') as f:
+    f.write(_paths_digest(dataset_paths))
+
+def load_character_cache(dataset_paths, cache_dir='character_cache', workers=8):
+  images_path = os.path.join(cache_dir, 'character_images.npy')
+  labels_path = os.path.join(cache_dir, 'character_labels.npy')
+  digest_path = os.path.join(cache_dir, 'character_paths.sha1')
+  digest = None
+  if os.path.exists(digest_path):
+    with open(digest_path) as f:
+      digest = f.read().strip()
+  if digest != _paths_digest(dataset_paths) or not (os.path.exists(images_path) and os.path.exists(labels_path)):
+    if os.path.exists(digest_path):
+      os.remove(digest_path)
+    build_character_cache(dataset_paths, cache_dir, workers)
+  return np.load(images_path, mmap_mode='r'), np.load(labels_path)
 
-X = np.array(X,dtype="float16")
-labels = np.array(labels)
+# Arange input data and corresponding labels
+X, labels = load_character_cache(dataset_paths)
 
 print("[INFO] Find {:d} images with {:d} classes".format(len(X),len(set(labels))))
 
@@ -549,6 +428,82 @@ image_gen = ImageDataGenerator(rotation_range=10,
                               fill_mode="nearest"
                               )
 
+"""ImageDataGenerator.flow augments on the Python side in a single thread, so most CPU cores sit idle during training. make_character_dataset builds the same augmentation as TensorFlow graph ops in a tf.data pipeline: rotation, width/height shift, shear (in degrees, like ImageDataGenerator) and zoom, with nearest fill. It applies them to whole batches with num_parallel_calls=AUTOTUNE and prefetches the next batches while the model trains. The random matrices are composed the same way as ImageDataGenerator.apply_transform does. X can be an image array or a list of file paths. File paths are decoded in parallel too, and with cache=True (or a filename) the decoded images are cached after the first epoch."""
+
+def random_transforms(batch_size, height, width, rotation_range=10, width_shift_range=0.1,
+                      height_shift_range=0.1, shear_range=0.1, zoom_range=0.1):
+    # (batch, 8) transforms for ImageProjectiveTransformV3, mapping output to input pixels
+    def uniform(limit):
+        return tf.random.uniform((batch_size,), -limit, limit)
+    theta = uniform(rotation_range) * np.pi / 180
+    tx = uniform(height_shift_range) * height
+    ty = uniform(width_shift_range) * width
+    shear = uniform(shear_range) * np.pi / 180
+    zx = 1 + uniform(zoom_range)
+    zy = 1 + uniform(zoom_range)
+    zeros, ones = tf.zeros((batch_size,)), tf.ones((batch_size,))
+
+    def matrices(*rows):
+        return tf.reshape(tf.stack(rows, axis=1), (batch_size, 3, 3))
+
+    # same order as ImageDataGenerator: rotation, shift, shear, zoom in (row, col)
+    rotation = matrices(tf.cos(theta), -tf.sin(theta), zeros, tf.sin(theta), tf.cos(theta), zeros, zeros, zeros, ones)
+    shift = matrices(ones, zeros, tx, zeros, ones, ty, zeros, zeros, ones)
+    shear = matrices(ones, -tf.sin(shear), zeros, zeros, tf.cos(shear), zeros, zeros, zeros, ones)
+    zoom = matrices(zx, zeros, zeros, zeros, zy, zeros, zeros, zeros, ones)
+    transform = rotation @ shift @ shear @ zoom
+
+    o_x, o_y = height / 2 - 0.5, width / 2 - 0.5
+    offset = tf.convert_to_tensor([[1., 0., o_x], [0., 1., o_y], [0., 0., 1.]])
+    reset = tf.convert_to_tensor([[1., 0., -o_x], [0., 1., -o_y], [0., 0., 1.]])
+    transform = offset @ transform @ reset
+
+    # (row, col) to (x, y) as expected by the image ops
+    swap = tf.constant([[0, 1, 0], [1, 0, 0], [0, 0, 1]], dtype=tf.float32)
+    transform = swap @ transform @ swap
+    return tf.reshape(transform, (batch_size, 9))[:, :8]
+
+def augment_batch(images, labels):
+    shape = tf.shape(images)
+    transforms = random_transforms(shape[0], tf.cast(shape[1], tf.float32), tf.cast(shape[2], tf.float32))
+    images = tf.raw_ops.ImageProjectiveTransformV3(images=images, transforms=transforms, output_shape=shape[1:3],
+                                                   fill_value=0., interpolation='BILINEAR', fill_mode='NEAREST')
+    return images, labels
+
+def decode_character(path, label):
+    image = tf.io.decode_jpeg(tf.io.read_file(path), channels=3)
+    return tf.image.resize(image, (80, 80), method='nearest'), label
+
+def make_character_dataset(X, y, batch_size=64, augment=True, cache=False, shuffle=True, seed=None):
+    dataset = tf.data.Dataset.from_tensor_slices((X, y))
+    if isinstance(X[0], str):
+        dataset = dataset.map(decode_character, num_parallel_calls=tf.data.AUTOTUNE)
+    if cache:
+        dataset = dataset.cache(cache if isinstance(cache, str) else '')
+    if shuffle:
+        dataset = dataset.shuffle(min(len(X), 10000), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.repeat().batch(batch_size)
+    dataset = dataset.map(lambda images, labels: (tf.cast(images, tf.float32), labels),
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    if augment:
+        dataset = dataset.map(augment_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+def compare_input_pipelines(X, y, batch_size=64, steps=100):
+    # steps/sec of the input pipelines alone, without the model
+    report = {}
+    pipelines = {'ImageDataGenerator': image_gen.flow(X, y, batch_size=batch_size),
+                 'tf.data': iter(make_character_dataset(X, y, batch_size))}
+    for name, pipeline in pipelines.items():
+        next(pipeline)
+        start = time.perf_counter()
+        for _ in range(steps):
+            next(pipeline)
+        report[name] = steps / (time.perf_counter() - start)
+    for name, steps_per_sec in report.items():
+        print("[INFO] {:<20s}{:8.1f} steps/sec".format(name, steps_per_sec))
+    return report
+
 # Create our model with pre-trained MobileNetV2 architecture from imagenet
 def create_model(lr=1e-4,decay=1e-4/25, training=False,output_shape=y.shape[1]):
     baseModel = MobileNetV2(weights="imagenet", 
@@ -587,23 +542,77 @@ my_checkpointer = [
                 ModelCheckpoint(filepath="License_character_recognition.h5", verbose=1, save_weights_only=True)
                 ]
 
-result = model.fit(image_gen.flow(trainX, trainY, batch_size=BATCH_SIZE), 
+compare_input_pipelines(trainX, trainY, BATCH_SIZE)
+
+USE_TF_DATA = True
+if USE_TF_DATA:
+    train_data = make_character_dataset(trainX, trainY, batch_size=BATCH_SIZE)
+else:
+    train_data = image_gen.flow(trainX, trainY, batch_size=BATCH_SIZE)
+
+result = model.fit(train_data, 
                    steps_per_epoch=len(trainX) // BATCH_SIZE, 
                    validation_data=(testX, testY), 
                    validation_steps=len(testX) // BATCH_SIZE, 
                    epochs=EPOCHS, callbacks=my_checkpointer)
 
-# Load model architecture, weight and labels
-json_file = open('/content/Plate_detect_and_recognize/MobileNets_character_recognition.json', 'r')
-loaded_model_json = json_file.read()
-json_file.close()
-model = model_from_json(loaded_model_json)
-model.load_weights("/content/Plate_detect_and_recognize/License_character_recognition_weight.h5")
-print("[INFO] Model loaded successfully...")
+"""For quick experiments on the classification head, fine-tuning the whole MobileNetV2 for every run is not needed. compute_backbone_features runs the frozen MobileNetV2 base (with the AveragePooling2D of the head) once over the whole dataset. It saves the pooled 1280-d features as float16 to disk, so later runs only load them. train_head then trains just the Dense(128) → Dropout → Dense(n) head on the cached features, which takes seconds. The features line up with X, so the same train_test_split call gives the same split. fine_tune_top_layers copies the trained head into a full create_model() network and fine-tunes only the top layers of the backbone on the images."""
 
-labels = LabelEncoder()
-labels.classes_ = np.load('/content/Plate_detect_and_recognize/license_character_classes.npy')
-print("[INFO] Labels loaded successfully...")
+def compute_backbone_features(X, cache_path='character_features.npy', batch_size=256):
+    if os.path.exists(cache_path):
+        return np.load(cache_path, mmap_mode='r')
+    baseModel = MobileNetV2(weights="imagenet",
+                            include_top=False,
+                            input_tensor=Input(shape=(80, 80, 3)))
+    pooled = AveragePooling2D(pool_size=(3, 3))(baseModel.output)
+    pooled = Flatten(name="flatten")(pooled)
+    extractor = Model(inputs=baseModel.input, outputs=pooled)
+    features = extractor.predict(X, batch_size=batch_size)
+    np.save(cache_path, features.astype(np.float16))
+    return np.load(cache_path, mmap_mode='r')
+
+def create_head(input_dim, output_shape, lr=1e-3):
+    inputs = Input(shape=(input_dim,))
+    headModel = Dense(128, activation="relu")(inputs)
+    headModel = Dropout(0.5)(headModel)
+    headModel = Dense(output_shape, activation="softmax")(headModel)
+    head = Model(inputs=inputs, outputs=headModel)
+    head.compile(loss="categorical_crossentropy", optimizer=Adam(lr=lr), metrics=["accuracy"])
+    return head
+
+def train_head(trainF, trainY, testF, testY, lr=1e-3, epochs=30, batch_size=256):
+    head = create_head(trainF.shape[1], trainY.shape[1], lr)
+    head.fit(np.asarray(trainF, dtype=np.float32), trainY,
+             validation_data=(np.asarray(testF, dtype=np.float32), testY),
+             batch_size=batch_size, epochs=epochs,
+             callbacks=[EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True)])
+    return head
+
+def fine_tune_top_layers(head, trainX, trainY, testX, testY, top_layers=20, lr=1e-5, epochs=5,
+                         batch_size=BATCH_SIZE, callbacks=None):
+    model = create_model(output_shape=trainY.shape[1])
+    # create_model ends with AveragePooling2D, Flatten, Dense, Dropout, Dense
+    model.layers[-3].set_weights(head.layers[1].get_weights())
+    model.layers[-1].set_weights(head.layers[3].get_weights())
+    for layer in model.layers[:-5]:
+        layer.trainable = False
+    for layer in model.layers[-5 - top_layers:-5]:
+        layer.trainable = True
+    model.compile(loss="categorical_crossentropy", optimizer=Adam(lr=lr), metrics=["accuracy"])
+    model.fit(make_character_dataset(trainX, trainY, batch_size=batch_size),
+              steps_per_epoch=len(trainX) // batch_size,
+              validation_data=(testX, testY),
+              epochs=epochs, callbacks=callbacks)
+    return model
+
+# features = compute_backbone_features(X)
+# (trainF, testF, trainY, testY) = train_test_split(features, y, test_size=0.10, stratify=y, random_state=42)
+# head = train_head(trainF, trainY, testF, testY)
+# model = fine_tune_top_layers(head, trainX, trainY, testX, testY, callbacks=my_checkpointer)
+
+# Load model architecture, weight and labels
+model = get_model('character')
+labels = get_labels()
 
 # pre-processing input images and pedict with model
 def predict_from_model(image,model,labels):
@@ -617,13 +626,615 @@ cols = len(crop_characters)
 grid = gridspec.GridSpec(ncols=cols,nrows=1,figure=fig)
 
 final_string = ''
+predictions = recognize_characters(crop_characters,model,labels)
 for i,character in enumerate(crop_characters):
     fig.add_subplot(grid[i])
-    title = np.array2string(predict_from_model(character,model,labels))
-    plt.title('{}'.format(title.strip("'[]"),fontsize=20))
-    final_string+=title.strip("'[]")
+    title = predictions[i]
+    plt.title('{}'.format(title,fontsize=20))
+    final_string+=title
     plt.axis(False)
     plt.imshow(character,cmap='gray')
 
 print(final_string)
-#plt.savefig('final_result.png', dpi=300)
\ No newline at end of file
+#plt.savefig('final_result.png', dpi=300)
+
+"""## Streaming recognition on video
+The functions above work on one still image at a time. VideoALPR runs the same pipeline over frames of a cv2.VideoCapture source (a camera index, a stream URL or a video file). Decoding, plate detection, character segmentation and recognition each run on their own threads and are connected by bounded queues. When drop_frames is True and a stage falls behind, the oldest waiting item is dropped so that results stay close to real time. When it is False, the upstream stage blocks instead, which is what you want for a video file where every frame should be processed. A frame whose stage function raises (a corrupt frame, a plate that fails to warp) is dropped and counted as failed in stats(), together with the last error, and the stream goes on."""
+
+class VideoALPR:
+    def __init__(self, source, wpod_net, model, labels, Dmax=608, Dmin=256, lp_threshold=0.5,
+                 queue_size=8, segment_workers=2, drop_frames=True):
+        self.source = source
+        self.wpod_net = wpod_net
+        self.model = model
+        self.labels = labels
+        self.Dmax, self.Dmin = Dmax, Dmin
+        self.lp_threshold = lp_threshold
+        self.decoded = 0
+        self.decode_dropped = 0
+
+        self.frames = queue.Queue(queue_size)
+        plates = queue.Queue(queue_size)
+        characters = queue.Queue(queue_size)
+        self.results = queue.Queue(queue_size)
+        self.stages = [PipelineStage('detect', self.detect, self.frames, plates, drop=drop_frames),
+                       PipelineStage('segment', self.segment, plates, characters,
+                                     workers=segment_workers, drop=drop_frames),
+                       PipelineStage('recognize', self.recognize, characters, self.results, drop=False)]
+        self.drop_frames = drop_frames
+
+    # stage functions, each takes and returns a dict describing one frame
+    def detect(self, item):
+        vehicle = cv2.cvtColor(item['frame'], cv2.COLOR_BGR2RGB)
+        ratio = float(max(vehicle.shape[:2])) / min(vehicle.shape[:2])
+        bound_dim = min(int(ratio * self.Dmin), self.Dmax)
+        _, LpImg, _, cor = detect_lp(self.wpod_net, vehicle, bound_dim, self.lp_threshold)
+        return {'frame_idx': item['frame_idx'], 'plates': LpImg, 'cor': cor}
+
+    def segment(self, item):
+        item['characters'] = [segment_characters(LpImg) for LpImg in item.pop('plates')]
+        return item
+
+    def recognize(self, item):
+        item['text'] = recognize_plates(item.pop('characters'), self.model, self.labels)
+        return item
+
+    def _decode(self):
+        cap = cv2.VideoCapture(self.source)
+        frame_idx = 0
+        try:
+            while True:
+                ok, frame = cap.read()
+                if not ok:
+                    break
+                item = {'frame_idx': frame_idx, 'frame': frame}
+                frame_idx += 1
+                self.decoded += 1
+                if not self.drop_frames:
+                    self.frames.put(item)
+                    continue
+                try:
+                    self.frames.put_nowait(item)
+                except queue.Full:
+                    # skip this frame rather than fall further behind the source
+                    self.decode_dropped += 1
+        finally:
+            cap.release()
+            self.frames.put(None)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        for stage in self.stages:
+            stage.start()
+        self._decoder = threading.Thread(target=self._decode, name='decode', daemon=True)
+        self._decoder.start()
+        return self
+
+    def __iter__(self):
+        # yields {'frame_idx', 'cor', 'text'} per frame that reached the end
+        if not hasattr(self, '_decoder'):
+            self.start()
+        while True:
+            item = self.results.get()
+            if item is None:
+                break
+            yield item
+        self._decoder.join()
+        for stage in self.stages:
+            stage.join()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.start_time
+        report = {'decode': {'processed': self.decoded,
+                             'dropped': self.decode_dropped,
+                             'fps': self.decoded / elapsed if elapsed else 0.0,
+                             'queue_depth': self.frames.qsize()}}
+        for stage in self.stages:
+            report[stage.name] = stage.stats()
+        return report
+
+# video_path = "/content/traffic.mp4"
+# alpr = VideoALPR(video_path, wpod_net, model, labels, drop_frames=False)
+# for result in alpr:
+#     print(result['frame_idx'], result['text'])
+# print(alpr.stats())
+
+"""## Tracking plates across frames
+On traffic footage the same car often stays in view for seconds, so running WPOD-net over every full frame repeats a lot of work. PlateTracker keeps a track for every plate found by detect_lp, keyed by its Cor quadrilateral. On the following frames it only runs WPOD-net on an expanded region around each track. A full-frame detection runs every detect_every frames, or whenever a tracked plate cannot be found in its region. The recognized string is cached per track. Characters are only recognized again when a small thumbnail of the plate crop changes by more than text_change grey levels on average."""
+
+def cor_to_box(cor):
+    return np.array([cor[0].min(), cor[1].min(), cor[0].max(), cor[1].max()], dtype=float)
+
+class PlateTrack:
+    __slots__ = ('track_id', 'cor', 'LpImg', 'missed', 'text', 'thumb')
+
+    def __init__(self, track_id, cor, LpImg):
+        self.track_id = track_id
+        self.cor = cor
+        self.LpImg = LpImg
+        self.missed = 0
+        self.text = None
+        self.thumb = None
+
+class PlateTracker:
+    def __init__(self, wpod_net, model, labels, Dmax=608, Dmin=256, lp_threshold=0.5,
+                 detect_every=15, roi_expand=1.0, roi_dim=256, max_missed=2,
+                 iou_threshold=0.3, text_change=12.0):
+        self.wpod_net = wpod_net
+        self.model = model
+        self.labels = labels
+        self.Dmax, self.Dmin = Dmax, Dmin
+        self.lp_threshold = lp_threshold
+        self.detect_every = detect_every
+        self.roi_expand = roi_expand
+        self.roi_dim = roi_dim
+        self.max_missed = max_missed
+        self.iou_threshold = iou_threshold
+        self.text_change = text_change
+
+        self.tracks = []
+        self.frame_idx = 0
+        self.next_id = 0
+        # counters to see how much work the tracking saves
+        self.full_detections = 0
+        self.roi_detections = 0
+        self.recognitions = 0
+
+    def _detect(self, vehicle, bound_dim, top_k=None):
+        _, LpImg, _, cor = detect_lp(self.wpod_net, vehicle, bound_dim, self.lp_threshold, top_k)
+        return LpImg, cor
+
+    def _full_detect(self, vehicle):
+        self.full_detections += 1
+        ratio = float(max(vehicle.shape[:2])) / min(vehicle.shape[:2])
+        bound_dim = min(int(ratio * self.Dmin), self.Dmax)
+        return self._detect(vehicle, bound_dim)
+
+    def _roi(self, cor, shape):
+        tlx, tly, brx, bry = cor_to_box(cor)
+        pad = self.roi_expand * max(brx - tlx, bry - tly)
+        x0, y0 = max(int(tlx - pad), 0), max(int(tly - pad), 0)
+        x1, y1 = min(int(brx + pad) + 1, shape[1]), min(int(bry + pad) + 1, shape[0])
+        return x0, y0, x1, y1
+
+    def _roi_detect(self, vehicle, track):
+        self.roi_detections += 1
+        x0, y0, x1, y1 = self._roi(track.cor, vehicle.shape)
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            return False
+        LpImg, cor = self._detect(vehicle[y0:y1, x0:x1], self.roi_dim, top_k=1)
+        if not len(LpImg):
+            return False
+        # plates come sorted by probability, keep the best one in the region
+        cor = np.array(cor[0], dtype=float)
+        cor[0] += x0
+        cor[1] += y0
+        track.cor, track.LpImg, track.missed = cor, LpImg[0], 0
+        return True
+
+    def _associate(self, LpImgs, cors):
+        matched_tracks, matched_dets = set(), set()
+        if self.tracks and len(cors):
+            boxes = np.array([cor_to_box(t.cor) for t in self.tracks] + [cor_to_box(c) for c in cors])
+            iou = IOU_matrix(boxes)[:len(self.tracks), len(self.tracks):]
+            iou = np.nan_to_num(iou)
+            # greedy matching from the highest overlap down
+            for flat in np.argsort(-iou, axis=None, kind='stable'):
+                ti, di = np.unravel_index(flat, iou.shape)
+                if iou[ti, di] < self.iou_threshold:
+                    break
+                if ti in matched_tracks or di in matched_dets:
+                    continue
+                track = self.tracks[ti]
+                track.cor, track.LpImg, track.missed = np.array(cors[di], dtype=float), LpImgs[di], 0
+                matched_tracks.add(ti)
+                matched_dets.add(di)
+
+        for ti, track in enumerate(self.tracks):
+            if ti not in matched_tracks:
+                track.missed += 1
+        self.tracks = [t for t in self.tracks if t.missed <= self.max_missed]
+        for di in range(len(cors)):
+            if di not in matched_dets:
+                self.tracks.append(PlateTrack(self.next_id, np.array(cors[di], dtype=float), LpImgs[di]))
+                self.next_id += 1
+
+    def _thumbnail(self, LpImg):
+        gray = cv2.cvtColor(plate_to_uint8(LpImg), cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, (32, 16), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def _recognize(self):
+        stale = []
+        for track in self.tracks:
+            if track.missed:
+                continue
+            thumb = self._thumbnail(track.LpImg)
+            if (track.text is None or track.thumb.shape != thumb.shape
+                    or np.abs(thumb - track.thumb).mean() > self.text_change):
+                track.thumb = thumb
+                stale.append(track)
+        if stale:
+            self.recognitions += len(stale)
+            texts = recognize_plates([segment_characters(t.LpImg) for t in stale], self.model, self.labels)
+            for track, text in zip(stale, texts):
+                track.text = text
+
+    def update(self, frame):
+        # frame is a BGR image as returned by cv2.VideoCapture.read()
+        vehicle = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        full = not self.tracks or self.frame_idx % self.detect_every == 0
+        if not full:
+            # a lost track falls back to a full-frame detection on this frame
+            full = not all([self._roi_detect(vehicle, track) for track in self.tracks])
+        if full:
+            LpImgs, cors = self._full_detect(vehicle)
+            self._associate(LpImgs, cors)
+        self._recognize()
+        self.frame_idx += 1
+        return [(t.track_id, t.cor, t.text) for t in self.tracks if not t.missed]
+
+    def stats(self):
+        return {'frames': self.frame_idx,
+                'full_detections': self.full_detections,
+                'roi_detections': self.roi_detections,
+                'recognitions': self.recognitions,
+                'tracks': len(self.tracks)}
+
+# cap = cv2.VideoCapture("/content/traffic.mp4")
+# tracker = PlateTracker(wpod_net, model, labels)
+# while True:
+#     ok, frame = cap.read()
+#     if not ok:
+#         break
+#     for track_id, cor, text in tracker.update(frame):
+#         print(tracker.frame_idx, track_id, text)
+# print(tracker.stats())
+
+"""## Bulk recognition over a directory
+For archives of images, bulk_alpr runs the full pipeline (decode, detection, segmentation and recognition) on a pool of worker processes. Each worker loads wpod-net and the character model once through the registry and then works through its share of the images. One JSON line per image is written to the output file as results arrive. Each line holds the plate strings, their quadrilaterals, lp_type and the time spent in every stage. The input is either a directory, searched recursively for images, or a text file with one image path per line. main() parses the same options from a command line, e.g. main(['/content/Plate_detect_and_recognize/Plate_examples', 'plates.jsonl', '--processes', '4']).
+
+TensorFlow is not fork-safe, so the workers are started with the spawn method. Each one imports alpr_pipeline in a fresh interpreter, loads its own copy of the models and runs TensorFlow on a single intra-op and inter-op thread, since the parallelism comes from the processes. The same command line is available outside the notebook as python alpr_pipeline.py SOURCE OUTPUT."""
+
+# main(['/content/Plate_detect_and_recognize/Plate_examples', 'plates.jsonl'])
+
+"""## Int8 TFLite models
+For CPU-only edge boxes both networks can be exported as int8 post-training-quantized TFLite models. The quantization ranges are calibrated on a small representative set: vehicles from Plate_examples for wpod-net and character crops from dataset_characters for the MobileNetV2 classifier. Inputs and outputs stay float32, so the interpreter is a drop-in replacement. get_model(name, backend='tflite') returns a model with the same predict(), which can be passed to detect_lp, predict_from_model, recognize_characters or bulk_alpr (--backend tflite). compare_backends then runs the same images through both backends and reports how often the plate strings agree and the latency of each."""
+
+def export_tflite_int8(model, representative_images, path, input_shape):
+    # input_shape excludes the batch axis, None for dimensions that stay dynamic
+    concrete = tf.function(lambda x: model(x, training=False)).get_concrete_function(
+        tf.TensorSpec(shape=(None,) + tuple(input_shape), dtype=tf.float32))
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete], model)
+
+    def representative_dataset():
+        for image in representative_images:
+            yield [np.asarray(image, dtype=np.float32)[np.newaxis]]
+
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    tflite_model = converter.convert()
+    with open(path, 'wb') as f:
+        f.write(tflite_model)
+    print("[INFO] Saved int8 model to {} ({:.1f} MB)".format(path, len(tflite_model) / 1e6))
+    return path
+
+def wpod_representative_images(image_paths, size=(384, 256), count=20):
+    # calibration only needs the activation ranges, so a common size is fine
+    return [cv2.resize(load_vehicle(path)[0], size).astype(np.float32) / 255 for path in image_paths[:count]]
+
+def character_representative_images(dataset_paths, count=200, seed=0):
+    rng = np.random.RandomState(seed)
+    picked = rng.choice(len(dataset_paths), size=min(count, len(dataset_paths)), replace=False)
+    return [img_to_array(load_img(dataset_paths[i], target_size=(80, 80))) for i in picked]
+
+def compare_backends(image_paths, backends=('keras', 'tflite')):
+    report = {}
+    results = {}
+    for backend in backends:
+        wpod, character = get_model('wpod-net', backend=backend), get_model('character', backend=backend)
+        results[backend] = [alpr_image(path, wpod, character, get_labels()) for path in image_paths]
+        timings = np.array([[r['timings']['detect'], r['timings']['recognize']] for r in results[backend]])
+        report[backend] = {'detect_ms': 1000 * timings[:, 0].mean(),
+                           'recognize_ms': 1000 * timings[:, 1].mean()}
+    reference = backends[0]
+    for backend in backends[1:]:
+        agree = sum([p['text'] for p in a['plates']] == [p['text'] for p in b['plates']]
+                    for a, b in zip(results[reference], results[backend]))
+        report[backend]['plate_agreement'] = agree / max(len(image_paths), 1)
+    return report
+
+export_tflite_int8(get_model('wpod-net'), wpod_representative_images(image_paths),
+                   TFLITE_PATHS['wpod-net'], (None, None, 3))
+export_tflite_int8(get_model('character'), character_representative_images(dataset_paths),
+                   TFLITE_PATHS['character'], (80, 80, 3))
+
+for backend, row in compare_backends(image_paths).items():
+    print(backend, row)
+
+"""## Per-stage latency benchmark
+benchmark_pipeline runs every Plate_examples image through each stage of the pipeline separately and records the latency of every call:
+- preprocess_image
+- the wpod_net.predict call
+- reconstruct, plus its nms and homography/warpPerspective steps on their own
+- thresholding and dilation
+- contour segmentation
+- predict_from_model per character, and recognize_characters per plate
+
+A full run from image path to plate string is timed as end_to_end. The report has p50/p95/p99 in milliseconds per stage, how far the resident memory (RSS) rose above its starting value while the stages ran, and the current git commit. It is written as JSON, and compare_benchmarks shows which stage changed between two reports."""
+
+def _percentiles(samples):
+    samples = np.array(samples) * 1000
+    if not len(samples):
+        return {'n': 0}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {'n': len(samples), 'mean': samples.mean(), 'p50': p50, 'p95': p95, 'p99': p99}
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _current_rss_mb():
+    # ru_maxrss is the peak of the whole process (model loading and training
+    # included), so the benchmark samples the current RSS where /proc has it
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+    except (OSError, ValueError, IndexError):
+        # elsewhere fall back to the process peak (kilobytes, bytes on macOS),
+        # whose growth still bounds what the stages added
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+class RSSSampler(threading.Thread):
+    # baseline is sampled in start() and a final sample is taken in stop(), so
+    # peak_delta is defined however short the run
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.baseline = self.peak = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        self.baseline = self.peak = _current_rss_mb()
+        super().start()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, _current_rss_mb())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, _current_rss_mb())
+        return self
+
+    @property
+    def peak_delta(self):
+        return self.peak - self.baseline
+
+def benchmark_pipeline(image_paths, wpod_net, model, labels, repeat=5, warmup=1, Dmax=608, Dmin=256,
+                       lp_threshold=0.5, output_path=None):
+    samples = {}
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        if run >= warmup:
+            samples.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def end_to_end(image_path):
+        vehicle = preprocess_image(image_path)
+        ratio = float(max(vehicle.shape[:2])) / min(vehicle.shape[:2])
+        _, LpImg, _, _ = detect_lp(wpod_net, vehicle, min(int(ratio * Dmin), Dmax), lp_threshold)
+        return recognize_plates([segment_characters(plate) for plate in LpImg], model, labels)
+
+    sampler = RSSSampler()
+    sampler.start()
+    for run in range(warmup + repeat):
+        for image_path in image_paths:
+            timed('end_to_end', end_to_end, image_path)
+
+            vehicle = timed('preprocess_image', preprocess_image, image_path)
+            ratio = float(max(vehicle.shape[:2])) / min(vehicle.shape[:2])
+            bound_dim = min(int(ratio * Dmin), Dmax)
+            Iresized = timed('resize', resize_for_lp, vehicle, bound_dim)
+            Yr = np.squeeze(timed('predict', wpod_net.predict, network_input(Iresized)))
+            if not Yr[..., 0].max() > lp_threshold:
+                continue
+            _, LpImg, lp_type, cor = timed('reconstruct', reconstruct, vehicle, Iresized, Yr, lp_threshold)
+
+            # sub-steps of reconstruct, timed on their own
+            Probs, Affines = Yr[..., 0], Yr[..., 2:]
+            xx, yy = np.where(Probs > lp_threshold)
+            pts, pts_frontal = affine_quads(Affines[xx, yy], xx, yy, getWH(Iresized.shape)/2**4, ((208 + 40)/2)/2**4)
+            timed('nms', lambda: (LabelBatch.from_quads(pts, Probs[xx, yy]).nms(0.1),
+                                  LabelBatch.from_quads(pts_frontal, Probs[xx, yy]).nms(0.1)))
+            out_size = (280, 200) if lp_type == 2 else (470, 110)
+            def warp():
+                t_ptsh = np.asarray(getRectPts(0, 0, out_size[0], out_size[1]))
+                return [cv2.warpPerspective(vehicle, H, out_size, borderValue=0)
+                        for H in find_T_matrices(np.asarray(cor), t_ptsh)]
+            timed('find_T_matrix_warp', warp)
+
+            characters = []
+            for plate in LpImg:
+                binary, _ = timed('threshold_dilate', binarize_plate, plate)
+                timed('segment_contours', character_boxes_contours, binary, binary.shape[0])
+                characters.append(segment_characters(plate))
+            for character in (c for plate in characters for c in plate):
+                timed('predict_from_model', predict_from_model, character, model, labels)
+            timed('recognize_characters', recognize_plates, characters, model, labels)
+    sampler.stop()
+
+    report = {'commit': _git_commit(),
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'platform': platform.platform(),
+              'images': len(image_paths),
+              'repeat': repeat,
+              # memory taken by the benchmarked stages on top of what was
+              # already resident (models, datasets) when the benchmark started
+              'rss_baseline_mb': sampler.baseline,
+              'peak_rss_delta_mb': sampler.peak_delta,
+              'stages': {stage: _percentiles(s) for stage, s in samples.items()}}
+    if output_path is None:
+        output_path = 'benchmark_{}.json'.format(report['commit'] or 'local')
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("[INFO] Benchmark report written to {}".format(output_path))
+    return report
+
+def compare_benchmarks(old_path, new_path, metric='p50'):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print('{:<22s}{:>12s}{:>12s}{:>10s}'.format('stage', old['commit'] or 'old', new['commit'] or 'new', 'ratio'))
+    for stage, stats in new['stages'].items():
+        if stage not in old['stages'] or metric not in stats or metric not in old['stages'][stage]:
+            continue
+        before, after = old['stages'][stage][metric], stats[metric]
+        print('{:<22s}{:>12.2f}{:>12.2f}{:>10.2f}'.format(stage, before, after, after / before if before else float('nan')))
+    if old.get('peak_rss_delta_mb') is not None and new.get('peak_rss_delta_mb') is not None:
+        print('{:<22s}{:>12.1f}{:>12.1f}'.format('peak_rss_delta_mb', old['peak_rss_delta_mb'], new['peak_rss_delta_mb']))
+
+benchmark_pipeline(image_paths, wpod_net, model, labels)
+
+"""## Caching results of repeated images
+Repeated uploads and parked-car cameras send the same image, or almost the same image, many times. PlateResultCache sits in front of detection and recognition and keys results on a BLAKE2 hash of the raw file bytes. With use_dhash=True it also keeps a 64-bit difference hash (dHash) of a small grayscale version of every image. A new image whose dHash is within max_distance bits of a cached one counts as a hit too. The dHashes are indexed by bands, so a lookup only compares against the entries that can be that close, and a near hit is stored under its own file hash so that the next identical copy is an exact hit. Data that cannot be decoded is always a miss. Entries hold the plate strings and Cor and are evicted least-recently-used beyond max_size. With a path, the cache is loaded from and saved to a JSON file so that it survives restarts. recognize_image_cached only runs the networks on a miss."""
+
+def file_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def dhash(data, hash_size=8):
+    # decode straight to a 1/8 size grayscale image, the hash only needs 9x8 pixels
+    try:
+        gray = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    except cv2.error:
+        gray = None
+    if gray is None:
+        return None
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return sum(1 << i for i, bit in enumerate(bits) if bit)
+
+DHASH_BITS = 64
+
+class PlateResultCache:
+    def __init__(self, max_size=10000, path=None, use_dhash=False, max_distance=4):
+        self.max_size = max_size
+        self.path = path
+        self.use_dhash = use_dhash
+        self.max_distance = max_distance
+        self.entries = OrderedDict()
+        # the dHash is cut into max_distance + 1 bands. Two hashes at most
+        # max_distance bits apart agree exactly on at least one band, so a
+        # lookup only compares against the keys that share a band with it.
+        self._band_bits = -(-DHASH_BITS // (max_distance + 1))
+        self._bands = {}
+        self.hits = self.near_hits = self.misses = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def _band_keys(self, phash):
+        mask = (1 << self._band_bits) - 1
+        return [(i, (phash >> (i * self._band_bits)) & mask) for i in range(self.max_distance + 1)]
+
+    def _insert(self, key, entry, phash):
+        # callers hold self._lock
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = dict(entry, dhash=phash)
+        if phash is not None:
+            for band in self._band_keys(phash):
+                self._bands.setdefault(band, set()).add(key)
+        while len(self.entries) > self.max_size:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        phash = self.entries.pop(key).get('dhash')
+        if phash is not None:
+            for band in self._band_keys(phash):
+                keys = self._bands[band]
+                keys.discard(key)
+                if not keys:
+                    del self._bands[band]
+
+    def lookup(self, data):
+        key = file_hash(data)
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return key, self.entries[key].get('dhash'), self.entries[key]
+        # only misses pay for decoding; undecodable data stays a miss
+        phash = dhash(data) if self.use_dhash else None
+        with self._lock:
+            if phash is not None:
+                candidates = set().union(*(self._bands.get(band, ()) for band in self._band_keys(phash)))
+                distances = [(bin(phash ^ self.entries[other]['dhash']).count('1'), other) for other in candidates]
+                if distances:
+                    distance, other = min(distances)
+                    if distance <= self.max_distance:
+                        entry = self.entries[other]
+                        self.entries.move_to_end(other)
+                        self.near_hits += 1
+                        # stored under this file's own hash too, so the next copy is an exact hit
+                        self._insert(key, entry, phash)
+                        return key, phash, entry
+            self.misses += 1
+        return key, phash, None
+
+    def put(self, key, entry, phash=None):
+        with self._lock:
+            self._insert(key, entry, phash)
+
+    def save(self):
+        with self._lock:
+            items = list(self.entries.items())
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(items, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        with open(self.path) as f:
+            items = json.load(f)
+        with self._lock:
+            self.entries, self._bands = OrderedDict(), {}
+            for key, entry in items[-self.max_size:]:
+                self._insert(key, entry, entry.get('dhash'))
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'near_hits': self.near_hits, 'misses': self.misses}
+
+def recognize_image_cached(image_path, cache, wpod_net, model, labels, Dmax=608, Dmin=256, lp_threshold=0.5):
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    key, phash, entry = cache.lookup(data)
+    if entry is not None:
+        return entry
+
+    vehicle = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) if len(data) else None
+    if vehicle is None:
+        raise ValueError('Cannot decode %s' % image_path)
+    vehicle = cv2.cvtColor(vehicle, cv2.COLOR_BGR2RGB)
+    ratio = float(max(vehicle.shape[:2])) / min(vehicle.shape[:2])
+    bound_dim = min(int(ratio * Dmin), Dmax)
+    _, LpImg, lp_type, cor = detect_lp(wpod_net, vehicle, bound_dim, lp_threshold)
+    texts = recognize_plates([segment_characters(plate) for plate in LpImg], model, labels)
+    entry = {'texts': [str(text) for text in texts],
+             'cor': [c[:2].tolist() for c in cor],
+             'lp_type': int(lp_type)}
+    cache.put(key, entry, phash)
+    return entry
+
+# cache = PlateResultCache(path='/content/plate_cache.json', use_dhash=True)
+# for image_path in image_paths:
+#     print(image_path, recognize_image_cached(image_path, cache, wpod_net, model, labels)['texts'])
+# cache.save()
+# print(cache.stats())
@@ -11,7 +11,6 @@ Original file is located at
 
 # Importing necessary libraries
 import pandas as pd
-import urllib
 import matplotlib.pyplot as plt
 import numpy as np
 import cv2
@@ -24,6 +23,7 @@ from keras.applications.vgg16 import VGG16
 from keras.layers import Flatten, Dense, Conv2D, MaxPooling2D, Input, Dropout
 from keras.models import Model, Sequential
 from keras.preprocessing.image import ImageDataGenerator
+from keras.utils import Sequence
 from keras.optimizers import Adam
 
 for dirname, _, filenames in os.walk('/colab/input'):
@@ -37,56 +37,142 @@ The two main elements of the data are content and annotation. Content contains l
 df = pd.read_json("https://raw.githubusercontent.com/sayakpaul/Vehicle-Number-Plate-Detection/master/Indian_Number_plates.json", lines=True)
 df.head()
 
-os.mkdir("Indian Number Plates")
-
-"""A simple scirpt to download and save all images to a directory while recording annotation information to a dictionary. The informations recorded contains image_width, image_height, x and y coordinates of top left cornet and x and y coordinates of bottom right corner of the bounding box ([top_x, top_y, bottom_x, bottom_y)"""
-
-dataset = dict()
-dataset["image_name"] = list()
-dataset["image_width"] = list()
-dataset["image_height"] = list()
-dataset["top_x"] = list()
-dataset["top_y"] = list()
-dataset["bottom_x"] = list()
-dataset["bottom_y"] = list()
-
-counter = 0
-for index, row in df.iterrows():
-    img = urllib.request.urlopen(row["content"])
-    img = Image.open(img)
-    img = img.convert('RGB')
-    img.save("Indian Number Plates/licensed_car{}.jpeg".format(counter), "JPEG")
-    
-    dataset["image_name"].append("licensed_car{}".format(counter))
-    
-    data = row["annotation"]
-    
-    dataset["image_width"].append(data[0]["imageWidth"])
-    dataset["image_height"].append(data[0]["imageHeight"])
-    dataset["top_x"].append(data[0]["points"][0]["x"])
-    dataset["top_y"].append(data[0]["points"][0]["y"])
-    dataset["bottom_x"].append(data[0]["points"][1]["x"])
-    dataset["bottom_y"].append(data[0]["points"][1]["y"])
-    
-    counter += 1
-print("Downloaded {} car images.".format(counter))
-
-# DataFrame object from the dictionary
-df = pd.DataFrame(dataset)
+os.makedirs("Indian Number Plates", exist_ok=True)
+
+"""Downloading the images one by one is slow, and one slow host stalls everything. download_images fetches them on a bounded thread pool, with each thread keeping a pooled HTTP connection session. Failed requests are retried with exponential backoff, except 4xx responses other than 408 and 429, which would fail again. Every saved file is recorded in a manifest.json (url, size, sha256) in the output directory, which is rewritten every flush_every completed downloads. When the download is restarted, files that are already on disk with the size (and, with verify_checksum=True, the checksum) from the manifest are skipped, so an interrupted download resumes where it stopped. The urls can point anywhere, including a local http.server for testing."""
+
+import hashlib
+import json
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def download_images(urls, directory, name_format="licensed_car{}.jpeg", workers=16, retries=4, backoff=0.5,
+                    timeout=30, manifest_path=None, verify_checksum=False, flush_every=50):
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = manifest_path or os.path.join(directory, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    sessions = threading.local()
+    def session():
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+            sessions.session.mount("http://", adapter)
+            sessions.session.mount("https://", adapter)
+        return sessions.session
+
+    def fetch(index, url):
+        name = name_format.format(index)
+        path = os.path.join(directory, name)
+        entry = manifest.get(name)
+        if (entry and entry.get("status") != "failed" and entry["url"] == url and os.path.exists(path)
+                and os.path.getsize(path) == entry["size"]
+                and (not verify_checksum or file_sha256(path) == entry["sha256"])):
+            return name, dict(entry, status="skipped")
+
+        error = None
+        for attempt in range(retries + 1):
+            try:
+                response = session().get(url, timeout=timeout)
+                response.raise_for_status()
+                img = Image.open(BytesIO(response.content)).convert('RGB')
+                # write to a temporary name so a crash never leaves a truncated image behind
+                tmp_path = path + ".part"
+                img.save(tmp_path, "JPEG")
+                os.replace(tmp_path, path)
+                return name, {"url": url, "size": os.path.getsize(path), "sha256": file_sha256(path),
+                              "status": "fetched", "attempts": attempt + 1}
+            except (requests.RequestException, OSError) as e:
+                error = repr(e)
+                status = e.response.status_code if isinstance(e, requests.HTTPError) and e.response is not None else None
+                # a missing or forbidden image will not come back on a retry
+                if status is not None and 400 <= status < 500 and status not in (408, 429):
+                    break
+                if attempt < retries:
+                    time.sleep(backoff * 2 ** attempt)
+        return name, {"url": url, "status": "failed", "error": error}
+
+    def save_manifest():
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    counts = {"fetched": 0, "skipped": 0, "failed": 0}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(fetch, index, url) for index, url in enumerate(urls)]
+            for done, future in enumerate(as_completed(futures), 1):
+                name, entry = future.result()
+                manifest[name] = entry
+                counts[entry["status"]] += 1
+                # written as we go, so a killed run resumes from the last flush
+                if done % flush_every == 0:
+                    save_manifest()
+    finally:
+        save_manifest()
+    print("Fetched {fetched}, skipped {skipped}, failed {failed} images.".format(**counts))
+    return manifest
+
+manifest = download_images(df["content"], "Indian Number Plates")
+
+"""The annotation information of all images is flattened in one vectorized pass. The informations recorded contains image_width, image_height, x and y coordinates of top left cornet and x and y coordinates of bottom right corner of the bounding box ([top_x, top_y, bottom_x, bottom_y). Every annotation of an image becomes its own row, so images with several plates keep all of them. The result is saved to a typed .npz file (float32 coordinates) that later runs load directly without parsing any JSON."""
+
+ANNOTATION_COLUMNS = ["image_name", "image_width", "image_height", "top_x", "top_y", "bottom_x", "bottom_y"]
+
+def ingest_annotations(df, path="indian_license_plates.npz"):
+    # one row per annotation, the index keeps the position of the image it belongs to
+    annotations = df["annotation"].reset_index(drop=True).explode().dropna()
+    flat = pd.json_normalize(annotations.tolist())
+    points = pd.json_normalize(annotations.tolist(), record_path="points")
+    assert len(points) == 2 * len(flat), "every annotation needs a top left and a bottom right point"
+    coords = points[["x", "y"]].to_numpy(dtype=np.float32).reshape(-1, 4)
+
+    image_index = annotations.index.to_numpy(dtype=np.int32)
+    np.savez(path,
+             image_index=image_index,
+             image_name=np.char.add("licensed_car", image_index.astype(str)),
+             image_width=flat["imageWidth"].to_numpy(dtype=np.int32),
+             image_height=flat["imageHeight"].to_numpy(dtype=np.int32),
+             top_x=coords[:, 0], top_y=coords[:, 1], bottom_x=coords[:, 2], bottom_y=coords[:, 3])
+    return path
+
+def load_annotations(path="indian_license_plates.npz"):
+    with np.load(path) as data:
+        return pd.DataFrame({column: data[column] for column in ANNOTATION_COLUMNS})
+
+if not os.path.exists("indian_license_plates.npz"):
+    ingest_annotations(df, "indian_license_plates.npz")
+df = load_annotations("indian_license_plates.npz")
+print("Recorded {} annotations of {} car images.".format(len(df), df["image_name"].nunique()))
 df.head()
 
-# converting it to csv for simplicity
-df.to_csv('indian_license_plates.csv', index=False)
-
-df = pd.read_csv("indian_license_plates.csv")
 df['image_name'] = df['image_name'] + '.jpeg'
 df.drop(['image_width', 'image_height'], axis=1, inplace=True)
+# images that failed to download are left out of the samples, the store and the split
+downloaded = np.array([os.path.exists(os.path.join('Indian Number Plates', name)) for name in df['image_name']], dtype=bool)
+if not downloaded.all():
+    print("Skipping {} annotations whose image is missing.".format((~downloaded).sum()))
+df = df[downloaded].reset_index(drop=True)
 df.head()
 
 """Here I have selected five random records from the dataframe for a later visual inspection of predictions. """
 
 lucky_test_samples = np.random.randint(0, len(df), 5)
-reduced_df = df.drop(lucky_test_samples, axis=0)
+# all annotations of those images are held out, not only the sampled rows
+reduced_df = df[~df['image_name'].isin(df['image_name'].iloc[lucky_test_samples])]
 
 # Viewing sample image
 WIDTH = 224
@@ -109,31 +195,85 @@ def show_img(index):
 
 show_img(5)
 
-"""I have created an ImageDataGenerator object to load batches of images to memory. I also splitted the data into two with a batch size of 32 images where training consists of 80% of the data and the rest is validation(20%)"""
-
-datagen = ImageDataGenerator(rescale=1.0/255.0, validation_split=0.1)
-
-train_generator = datagen.flow_from_dataframe(
-    reduced_df, 
-    directory='Indian Number Plates/',
-    x_col='image_name', 
-    y_col=['top_x', 'top_y', 'bottom_x', 'bottom_y'],
-    target_size=(WIDTH, HEIGHT),
-    batch_size=32,
-    class_mode='other',
-    subset='training'
-)
-
-validation_generator = datagen.flow_from_dataframe(
-    reduced_df,
-    directory='Indian Number Plates/',
-    x_col='image_name',
-    y_col=['top_x', 'top_y', 'bottom_x', 'bottom_y'],
-    target_size=(WIDTH, HEIGHT),
-    batch_size=32,
-    class_mode='other',
-    subset='validation'
-)
+"""Instead of an ImageDataGenerator that decodes and resizes every JPEG on every epoch, all images are resized once into a single memory-mapped uint8 array of shape (N, 224, 224, 3), with row i belonging to row i of df. They are resized exactly like flow_from_dataframe does (RGB, nearest). ImageStoreSequence then serves batches straight from that array, rescaled by 1/255, together with the bounding box columns. The image names are saved next to the array, and the store is rebuilt when df holds other images or the same images in another order. The split follows validation_split=0.1, but by image: the first 10% of the images in reduced_df, with all their annotations, are used for validation and the rest, with a batch size of 32, for training, so no image has boxes on both sides."""
+
+BOX_COLUMNS = ['top_x', 'top_y', 'bottom_x', 'bottom_y']
+
+def _load_resized(path):
+    with Image.open(path) as img:
+        img = img.convert('RGB')
+        if img.size != (WIDTH, HEIGHT):
+            img = img.resize((WIDTH, HEIGHT), Image.NEAREST)
+        return np.asarray(img, dtype=np.uint8)
+
+def _names_path(path):
+    return os.path.splitext(path)[0] + '_names.npy'
+
+def _store_matches(path, names):
+    # a cached array is reused only for the same images in the same order
+    names_path = _names_path(path)
+    if not (os.path.exists(path) and os.path.exists(names_path)):
+        return False
+    return np.array_equal(np.load(names_path), names)
+
+def _start_store(path):
+    if os.path.exists(_names_path(path)):
+        os.remove(_names_path(path))
+
+def _finish_store(path, names):
+    # the names are written last, so an interrupted build is never reused
+    np.save(_names_path(path), names)
+    return np.load(path, mmap_mode='r')
+
+def build_image_store(df, directory='Indian Number Plates/', path='indian_license_plates_224.npy', workers=8):
+    names = df['image_name'].to_numpy(dtype=str)
+    if _store_matches(path, names):
+        return np.load(path, mmap_mode='r')
+    _start_store(path)
+    images = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.uint8, shape=(len(df), HEIGHT, WIDTH, CHANNEL))
+    paths = [os.path.join(directory, name) for name in df['image_name']]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i, image in enumerate(pool.map(_load_resized, paths)):
+            images[i] = image
+    images.flush()
+    del images
+    os.replace(path + '.tmp', path)
+    return _finish_store(path, names)
+
+class ImageStoreSequence(Sequence):
+    def __init__(self, images, boxes, indices, batch_size=32, shuffle=True, rescale=1.0/255.0):
+        self.images = images
+        self.rescale = rescale
+        self.boxes = np.asarray(boxes, dtype=np.float32)
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.n = len(self.indices)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(self.n / self.batch_size))
+
+    def __getitem__(self, i):
+        # sorted indices read the memory map front to back
+        idx = np.sort(self.order[i * self.batch_size:(i + 1) * self.batch_size])
+        return self.images[idx].astype(np.float32) * self.rescale, self.boxes[idx]
+
+    def on_epoch_end(self):
+        self.order = np.random.permutation(self.indices) if self.shuffle else self.indices
+
+image_store = build_image_store(df)
+boxes = df[BOX_COLUMNS].to_numpy(dtype=np.float32)
+
+# row positions of reduced_df in df; the first 10% of its images, with all
+# their annotations, are the validation subset
+reduced_rows = df.index.get_indexer(reduced_df.index)
+reduced_names = df['image_name'].to_numpy()[reduced_rows]
+reduced_images = pd.unique(reduced_names)
+is_validation = np.isin(reduced_names, reduced_images[:int(0.1 * len(reduced_images))])
+
+train_generator = ImageStoreSequence(image_store, boxes, reduced_rows[~is_validation], batch_size=32)
+validation_generator = ImageStoreSequence(image_store, boxes, reduced_rows[is_validation], batch_size=32)
 
 model = Sequential()
 model.add(VGG16(weights='imagenet', include_top=False, input_shape=(HEIGHT, WIDTH, CHANNEL)))
@@ -161,11 +301,50 @@ print('Validation step size:', STEP_SIZE_VAL)
 adam = Adam(lr=0.0005)
 model.compile(optimizer=adam, loss='mse')
 
-history = model.fit_generator(train_generator, 
-                              steps_per_epoch=STEP_SIZE_TRAIN,
-                              validation_data=validation_generator,
-                              validation_steps=STEP_SIZE_VAL,
-                              epochs=30)
+"""The VGG16 base is frozen and no augmentation is used, so its output for a given image is the same in every epoch. With USE_BOTTLENECK_FEATURES the base runs once over the image store, and its (7, 7, 512) feature maps are cached as float16 on disk. Only the Flatten → Dense(128) → Dense(64) → Dense(64) → Dense(4) head is trained on them, with the same optimizer, loss, split, batch size and number of epochs. The only difference from training end to end is the float16 rounding of the cached features. The trained head weights are then copied back into model, so evaluation and inspection below use the full network as before. With augmentation, the features change per epoch and the regular fit has to be used."""
+
+USE_BOTTLENECK_FEATURES = True
+
+def build_feature_store(base, image_store, names, path='indian_license_plates_vgg16.npy', batch_size=32):
+    if _store_matches(path, names):
+        return np.load(path, mmap_mode='r')
+    _start_store(path)
+    batches = ImageStoreSequence(image_store, np.zeros((len(image_store), 4)), np.arange(len(image_store)),
+                                 batch_size=batch_size, shuffle=False)
+    features = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float16,
+                                         shape=(len(image_store),) + base.output_shape[1:])
+    for i in range(len(batches)):
+        images, _ = batches[i]
+        features[i * batch_size:i * batch_size + len(images)] = base.predict(images)
+    features.flush()
+    del features
+    os.replace(path + '.tmp', path)
+    return _finish_store(path, names)
+
+if USE_BOTTLENECK_FEATURES:
+    features = build_feature_store(model.layers[0], image_store, df['image_name'].to_numpy(dtype=str))
+
+    head = Sequential()
+    head.add(Flatten(input_shape=model.layers[0].output_shape[1:]))
+    for layer in model.layers[2:]:
+        head.add(Dense(layer.units, activation=layer.activation))
+    head.compile(optimizer=Adam(lr=0.0005), loss='mse')
+
+    history = head.fit(ImageStoreSequence(features, boxes, train_generator.indices, batch_size=32, rescale=1.0),
+                       steps_per_epoch=STEP_SIZE_TRAIN,
+                       validation_data=ImageStoreSequence(features, boxes, validation_generator.indices,
+                                                          batch_size=32, rescale=1.0),
+                       validation_steps=STEP_SIZE_VAL,
+                       epochs=30)
+
+    for layer, trained in zip(model.layers[1:], head.layers):
+        layer.set_weights(trained.get_weights())
+else:
+    history = model.fit_generator(train_generator, 
+                                  steps_per_epoch=STEP_SIZE_TRAIN,
+                                  validation_data=validation_generator,
+                                  validation_steps=STEP_SIZE_VAL,
+                                  epochs=30)
 
 plt.plot(history.history['loss'])
 plt.plot(history.history['val_loss'])
@@ -177,15 +356,66 @@ plt.show()
 
 model.evaluate(validation_generator, steps=STEP_SIZE_VAL)
 
+"""predict_boxes localizes the plates of a whole list of images at once. It decodes the images on a thread pool, the same way as for the image store, one batch of batch_size images at a time: the next batch is decoded while the current one is predicted, so memory stays at two batches however long the list is. Each batch is stacked into a float32 tensor for one predict call. The normalized outputs are scaled back to pixel boxes [top_x, top_y, bottom_x, bottom_y] in every original image. render_boxes draws those boxes on the original images and writes them to disk in parallel. Together they make it practical to evaluate the whole validation set."""
+
+def image_size(path):
+    # only reads the header
+    with Image.open(path) as img:
+        return img.size
+
+def _load_for_prediction(path):
+    return _load_resized(path), image_size(path)
+
+def predict_boxes(paths, batch_size=32, workers=8):
+    paths = list(paths)
+    boxes = np.empty((len(paths), 4), dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit(start):
+            return [pool.submit(_load_for_prediction, path) for path in paths[start:start + batch_size]]
+
+        # the next batch is decoded while the current one is predicted, so at
+        # most two batches of images are held in memory
+        pending = submit(0)
+        for start in range(0, len(paths), batch_size):
+            loaded, pending = pending, submit(start + batch_size)
+            images, sizes = zip(*[future.result() for future in loaded])
+            batch = np.stack(images).astype(np.float32) * (1.0 / 255.0)
+            scale = np.array(sizes, dtype=np.float32)[:, [0, 1, 0, 1]]
+            boxes[start:start + len(images)] = model.predict(batch, batch_size=len(images)) * scale
+    return boxes
+
+def _draw_box(path, box, output_path, color=(0, 0, 255), thickness=2):
+    image = cv2.imread(path)
+    tx, ty, bx, by = np.round(box).astype(int)
+    cv2.rectangle(image, (tx, ty), (bx, by), color, thickness)
+    cv2.imwrite(output_path, image)
+    return output_path
+
+def render_boxes(paths, boxes, output_dir, workers=8):
+    os.makedirs(output_dir, exist_ok=True)
+    output_paths = [os.path.join(output_dir, os.path.basename(path)) for path in paths]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_draw_box, paths, boxes, output_paths))
+
+def box_iou(a, b):
+    wh = np.clip(np.minimum(a[:, 2:], b[:, 2:]) - np.maximum(a[:, :2], b[:, :2]), 0, None)
+    intersection = wh.prod(axis=1)
+    area_a = (a[:, 2:] - a[:, :2]).prod(axis=1)
+    area_b = (b[:, 2:] - b[:, :2]).prod(axis=1)
+    return intersection / (area_a + area_b - intersection)
+
+# Evaluation on the whole validation set, in the pixels of the original images
+validation_rows = validation_generator.indices
+validation_paths = ['Indian Number Plates/' + name for name in df['image_name'].iloc[validation_rows]]
+predicted = predict_boxes(validation_paths)
+sizes = np.array([image_size(path) for path in validation_paths], dtype=np.float32)[:, [0, 1, 0, 1]]
+print('Mean IoU on the validation set:', box_iou(predicted, boxes[validation_rows] * sizes).mean())
+render_boxes(validation_paths, predicted, 'Validation predictions')
+
 # Inspection of the five samples
-for idx, row in df.iloc[lucky_test_samples].iterrows():    
-    img = cv2.resize(cv2.imread("Indian Number Plates/" + row[0]) / 255.0, dsize=(WIDTH, HEIGHT))
-    y_hat = model.predict(img.reshape(1, WIDTH, HEIGHT, 3)).reshape(-1) * WIDTH
-    
-    xt, yt = y_hat[0], y_hat[1]
-    xb, yb = y_hat[2], y_hat[3]
-    
-    img = cv2.cvtColor(img.astype(np.float32), cv2.COLOR_BGR2RGB)
-    image = cv2.rectangle(img, (xt, yt), (xb, yb), (0, 0, 255), 1)
+sample_paths = ['Indian Number Plates/' + name for name in df['image_name'].iloc[lucky_test_samples]]
+for path, (xt, yt, xb, yb) in zip(sample_paths, predict_boxes(sample_paths)):
+    image = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+    image = cv2.rectangle(image, (int(xt), int(yt)), (int(xb), int(yb)), (0, 0, 255), 2)
     plt.imshow(image)
-    plt.show()
\ No newline at end of file
+    plt.show()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the notebooks import alpr_pipeline from the directory they run in
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
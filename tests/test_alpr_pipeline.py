@@ -0,0 +1,99 @@
+import queue
+
+import cv2
+import numpy as np
+import pytest
+from keras import Input, Sequential
+from keras.layers import Conv2D, MaxPooling2D
+from PIL import Image, ImageOps
+
+import alpr_pipeline
+
+
+@pytest.fixture(scope='module')
+def stride16_model():
+    # same stride and pooling as wpod-net: 'same' convolutions, four 2x2 'valid' poolings
+    layers = [Input((None, None, 3))]
+    for _ in range(4):
+        layers += [Conv2D(4, 3, padding='same'), MaxPooling2D((2, 2))]
+    layers.append(Conv2D(8, 3, padding='same'))
+    return Sequential(layers)
+
+
+@pytest.mark.parametrize('bucket', [None, 16, 32, 100])
+def test_detect_lp_batch_crops_bucketed_maps_to_unpadded_size(stride16_model, monkeypatch, bucket):
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 255, (h, w, 3)).astype(np.uint8) for h, w in ((250, 377), (240, 320), (333, 500))]
+    max_dims = [250, 256, 270]
+    shapes = []
+    monkeypatch.setattr(alpr_pipeline, 'reconstruct_or_none',
+                        lambda I, Iresized, Yr, *args: shapes.append(Yr.shape) or alpr_pipeline.NO_PLATE)
+    alpr_pipeline.detect_lp_batch(stride16_model, images, max_dims, 0.5, bucket=bucket)
+
+    expected = []
+    for image, max_dim in zip(images, max_dims):
+        T = alpr_pipeline.network_input(alpr_pipeline.resize_for_lp(image, max_dim))
+        expected.append(stride16_model.predict(T, verbose=0).shape[1:])
+    assert sorted(shapes) == sorted(expected)
+
+
+def _run_stage(func, items, workers):
+    in_queue, out_queue = queue.Queue(), queue.Queue()
+    stage = alpr_pipeline.PipelineStage('test', func, in_queue, out_queue, workers=workers, drop=False)
+    stage.start()
+    for item in items:
+        in_queue.put(item)
+    in_queue.put(None)
+    results = []
+    while True:
+        item = out_queue.get(timeout=10)
+        if item is None:
+            break
+        results.append(item)
+    stage.join()
+    return stage, results
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_pipeline_stage_survives_a_raising_function(workers):
+    def func(item):
+        if item % 3 == 0:
+            raise ValueError('corrupt frame %d' % item)
+        return item * 10
+
+    stage, results = _run_stage(func, range(10), workers)
+    assert sorted(results) == [10, 20, 40, 50, 70, 80]
+    stats = stage.stats()
+    assert stats['processed'] == 6
+    assert stats['failed'] == 4
+    assert 'corrupt frame' in stats['last_error']
+
+
+def test_pipeline_stage_forwards_sentinel_when_every_item_fails():
+    def func(item):
+        raise RuntimeError('cannot warp')
+
+    stage, results = _run_stage(func, range(5), workers=2)
+    assert results == []
+    assert stage.stats()['failed'] == 5
+
+
+@pytest.mark.parametrize('orientation', [1, 3, 6, 8])
+@pytest.mark.parametrize('Dmax, factor', [(608, 1), (40, 2)])
+def test_load_vehicle_keeps_exif_rotation(tmp_path, orientation, Dmax, factor):
+    # stored as 400x200 with a red top left corner, displayed rotated for orientations 3, 6 and 8
+    stored = np.zeros((200, 400, 3), dtype=np.uint8)
+    stored[:50, :100] = (255, 0, 0)
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    path = str(tmp_path / 'vehicle.jpg')
+    Image.fromarray(stored).save(path, exif=exif, quality=95)
+
+    with Image.open(path) as im:
+        upright = np.asarray(ImageOps.exif_transpose(im).convert('RGB'))
+    img, scale = alpr_pipeline.load_vehicle(path, Dmax=Dmax)
+
+    assert img.shape[:2] == (upright.shape[0] // factor, upright.shape[1] // factor)
+    np.testing.assert_allclose(scale, [factor, factor])
+    reduced = cv2.resize(upright, img.shape[1::-1], interpolation=cv2.INTER_AREA)
+    assert np.abs(img.astype(int) - reduced.astype(int)).mean() < 10